@@ -0,0 +1,407 @@
+""" A local stand-in for the parts of the Spotify Web API that Vibe Compass uses.
+Serves the token, playlist, playlist tracks, tracks, audio-features, player queue and playlist creation endpoints,
+with configurable latency, page sizes, rate limiting and error payloads in the same shapes
+spotifyAPI.Client.status_code_check parses.
+
+Run standalone with `python fake_spotify.py --port 8900`, or start it in-process with FakeSpotify(...).start() """
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import ascii_letters, digits
+from urllib.parse import urlsplit, parse_qs
+
+BASE62 = digits + ascii_letters
+
+def spotify_id(rng):
+    """ Returns a random 22 character base62 id, the same shape as a Spotify id """
+    return "".join(rng.choice(BASE62) for _ in range(22))
+
+class FakeSpotify(object):
+    """ Fake Spotify API server. Every user sees the same playlists, which draw tracks from one shared pool
+    so that playlists overlap like real libraries do """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.05, jitter=0.0, page_size=100, playlists=60,
+                tracks_per_playlist=250, track_pool=5000, rate_limit=0.0, error_rate=0.0, no_device_rate=0.0,
+                token_lifetime=3600, seed=0):
+        self.host = host
+        self.port = port
+        self.latency = latency # seconds added to every response
+        self.jitter = jitter # extra uniform random latency up to this many seconds
+        self.page_size = page_size # maximum page size the server will honour
+        self.rate_limit = rate_limit # probability of a 429 on any API request
+        self.error_rate = error_rate # probability of a 500 on any API request
+        self.no_device_rate = no_device_rate # probability a queue request fails with no active device
+        self.token_lifetime = token_lifetime
+        self.stats = Counter() # requests served per endpoint and status
+        self._stats_lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._server = None
+        self._thread = None
+
+        # Build the catalog
+        self.tracks = {}
+        for n in range(track_pool):
+            track_id = spotify_id(self._rng)
+            self.tracks[track_id] = {
+                "id": track_id,
+                "name": f"Track {n}",
+                "artists": [{"name": f"Artist {n % 500}"}],
+                "album": {"images": [{"url": f"https://i.scdn.co/image/{track_id}-{size}", "height": size, "width": size} for size in (640, 300, 64)]},
+                "uri": f"spotify:track:{track_id}",
+                "danceability": round(self._rng.random(), 3),
+                "energy": round(self._rng.random(), 3),
+                "valence": round(self._rng.random(), 3),
+            }
+        pool = list(self.tracks)
+        self.playlists = {}
+        for n in range(playlists):
+            playlist_id = spotify_id(self._rng)
+            self.playlists[playlist_id] = {
+                "id": playlist_id,
+                "name": f"Playlist {n}",
+                "snapshot_id": spotify_id(self._rng),
+                "tracks": self._rng.sample(pool, min(tracks_per_playlist, len(pool))),
+            }
+        self.created = {} # playlists made through the API, kept apart so every user's directory stays the same
+        self._created_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def start(self):
+        """ Starts serving in a daemon thread and returns the base url """
+        fake = self
+        class Handler(FakeSpotifyHandler):
+            server_state = fake
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1] # port=0 picks a free port
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-spotify", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def install(self, module=None):
+        """ Points spotifyAPI (or the given module) at this server """
+        if module is None:
+            import spotifyAPI as module
+        module.ACCOUNTS_URL = f"{self.url}/api"
+        module.API_URL = f"{self.url}/v1"
+
+    def count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def roll(self, probability):
+        with self._stats_lock:
+            return self._rng.random() < probability
+
+    def delay(self):
+        with self._stats_lock:
+            extra = self._rng.uniform(0, self.jitter) if self.jitter else 0
+        if self.latency + extra > 0:
+            time.sleep(self.latency + extra)
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    """ Request handler. server_state is set to the FakeSpotify instance by FakeSpotify.start """
+    server_state = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass # keep load tests quiet
+
+    # Responses
+    def send_json(self, status_code, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_empty(self, status_code=204):
+        self.send_response(status_code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def api_error(self, status_code, message, headers=None):
+        """ Web API errors look like {"error": {"status": ..., "message": ...}} """
+        self.send_json(status_code, {"error": {"status": status_code, "message": message}}, headers)
+
+    def auth_error(self, message, error="invalid_grant"):
+        """ Accounts service errors look like {"error": ..., "error_description": ...} """
+        self.send_json(400, {"error": error, "error_description": message})
+
+    # Routing
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        fake = self.server_state
+        parts = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        path = parts.path.rstrip("/").split("/")[1:]
+
+        # Drain any request body so keep-alive connections stay in sync
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+
+        fake.delay()
+        if path == ["api", "token"] and method == "POST":
+            fake.count("token")
+            return self.token()
+        if not path or path[0] != "v1":
+            fake.count("not_found")
+            return self.api_error(404, "Service not found")
+
+        endpoint = self.endpoint_name(method, path[1:])
+        fake.count(endpoint)
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            fake.count("401")
+            return self.api_error(401, "No token provided")
+        if fake.roll(fake.rate_limit):
+            fake.count("429")
+            return self.api_error(429, "API rate limit exceeded", headers={"Retry-After": "1"})
+        if fake.roll(fake.error_rate):
+            fake.count("500")
+            return self.api_error(500, "Server error")
+
+        handler = getattr(self, endpoint.replace("-", "_"), None)
+        if handler is None:
+            return self.api_error(404, "Service not found")
+        return handler(path[1:])
+
+    @staticmethod
+    def endpoint_name(method, path):
+        if path == ["me"]:
+            return "me"
+        if path[:1] == ["users"] and path[2:] == ["playlists"] and method == "POST":
+            return "create_playlist"
+        if path[:1] == ["playlists"] and path[2:3] == ["tracks"] and method == "POST":
+            return "add_tracks"
+        if path[:2] == ["me", "playlists"]:
+            return "me_playlists"
+        if path[:1] == ["playlists"] and path[2:3] == ["tracks"]:
+            return "playlist_tracks"
+        if path[:1] == ["audio-features"]:
+            return "audio_features"
+        if path[:1] == ["tracks"]:
+            return "tracks"
+        if path[:3] == ["me", "player", "queue"] and method == "POST":
+            return "queue"
+        return "not_found"
+
+    def paging(self, default_limit, max_limit):
+        """ Returns limit/offset from the query, capped like Spotify does """
+        try:
+            limit = int(self.query.get("limit", default_limit))
+            offset = int(self.query.get("offset", 0))
+        except ValueError:
+            return None, None
+        if not 1 <= limit <= max_limit or offset < 0:
+            return None, None
+        return limit, offset
+
+    def page(self, base, items, limit, offset, extra_query=""):
+        total = len(items)
+        next_url = f"{base}?offset={offset+limit}&limit={limit}{extra_query}" if offset + limit < total else None
+        prev_url = f"{base}?offset={max(offset-limit, 0)}&limit={limit}{extra_query}" if offset > 0 else None
+        return {"href": f"{base}?offset={offset}&limit={limit}{extra_query}", "items": items[offset:offset+limit],
+                "limit": limit, "offset": offset, "total": total, "next": next_url, "previous": prev_url}
+
+    # Endpoints
+    def token(self):
+        fake = self.server_state
+        grant_type = self.query.get("grant_type")
+        if grant_type == "authorization_code":
+            code = self.query.get("code", "")
+            if code in ("", "invalid"):
+                return self.auth_error("Invalid authorization code")
+            refresh_token = f"refresh-{code}"
+        elif grant_type == "refresh_token":
+            refresh_token = self.query.get("refresh_token", "")
+            if refresh_token in ("", "revoked"):
+                return self.auth_error("Refresh token revoked")
+        else:
+            return self.auth_error("grant_type must be client_credentials, authorization_code or refresh_token", error="unsupported_grant_type")
+
+        body = {"access_token": f"access-{refresh_token}", "token_type": "Bearer", "expires_in": fake.token_lifetime,
+                "scope": "user-modify-playback-state playlist-read-private playlist-read-collaborative playlist-modify-private playlist-modify-public"}
+        if grant_type == "authorization_code":
+            body["refresh_token"] = refresh_token
+        self.send_json(200, body)
+
+    def me_playlists(self, path):
+        fake = self.server_state
+        limit, offset = self.paging(20, 50)
+        if limit is None:
+            return self.api_error(400, "Invalid limit")
+        items = [ {"id": p["id"], "name": p["name"], "snapshot_id": p["snapshot_id"],
+                "tracks": {"href": f"{fake.url}/v1/playlists/{p['id']}/tracks", "total": len(p["tracks"])}}
+                for p in fake.playlists.values() ]
+        self.send_json(200, self.page(f"{fake.url}/v1/me/playlists", items, limit, offset))
+
+    def playlist_tracks(self, path):
+        fake = self.server_state
+        playlist = fake.playlists.get(path[1]) or fake.created.get(path[1])
+        if playlist is None:
+            return self.api_error(404, "Not found.")
+        limit, offset = self.paging(100, 100)
+        if limit is None:
+            return self.api_error(400, "Invalid limit")
+        limit = min(limit, fake.page_size)
+        items = [ {"track": self.track_object(track_id)} for track_id in playlist["tracks"] ]
+        market = f"&market={self.query['market']}" if "market" in self.query else ""
+        self.send_json(200, self.page(f"{fake.url}/v1/playlists/{playlist['id']}/tracks", items, limit, offset, market))
+
+    def track_object(self, track_id):
+        track = self.server_state.tracks[track_id]
+        return {key: track[key] for key in ("id", "name", "artists", "album", "uri")}
+
+    def ids(self, max_ids):
+        ids = [ i for i in self.query.get("ids", "").split(",") if i ]
+        if len(ids) == 0:
+            return None, "invalid id"
+        if len(ids) > max_ids:
+            return None, "Too many ids requested"
+        if any(len(i) != 22 or i.strip(BASE62) for i in ids): # Spotify rejects the whole request for one malformed id
+            return None, "invalid id"
+        return ids, None
+
+    def audio_features(self, path):
+        fake = self.server_state
+        ids, error = self.ids(100)
+        if error:
+            return self.api_error(400, error)
+        features = []
+        for track_id in ids:
+            track = fake.tracks.get(track_id)
+            features.append(None if track is None else
+                {"id": track_id, "uri": track["uri"], "danceability": track["danceability"],
+                "energy": track["energy"], "valence": track["valence"]})
+        self.send_json(200, {"audio_features": features})
+
+    def tracks(self, path):
+        fake = self.server_state
+        if len(path) > 1: # tracks/{id}
+            if path[1] not in fake.tracks:
+                return self.api_error(400 if "," in path[1] else 404, "invalid id")
+            return self.send_json(200, self.track_object(path[1]))
+        ids, error = self.ids(50)
+        if error:
+            return self.api_error(400, error)
+        self.send_json(200, {"tracks": [ self.track_object(i) if i in fake.tracks else None for i in ids ]})
+
+    def queue(self, path):
+        fake = self.server_state
+        uri = self.query.get("uri", "")
+        if not uri.startswith("spotify:track:") or uri.split(":")[-1] not in fake.tracks:
+            return self.api_error(400, "Invalid base62 id")
+        if fake.roll(fake.no_device_rate):
+            return self.api_error(404, "Player command failed: No active device found")
+        self.send_empty(204)
+
+    def user_id(self):
+        """ Every access token belongs to its own user """
+        token = self.headers.get("Authorization", "")[len("Bearer "):]
+        return "user-" + hashlib.sha1(token.encode()).hexdigest()[:12]
+
+    def json_body(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            return None
+
+    def me(self, path):
+        self.send_json(200, {"id": self.user_id(), "display_name": "Load Test", "type": "user"})
+
+    def create_playlist(self, path):
+        fake = self.server_state
+        body = self.json_body()
+        if body is None or not body.get("name"):
+            return self.api_error(400, "Missing required field: name")
+        if path[1] != self.user_id():
+            return self.api_error(403, "You cannot create a playlist for another user")
+        with fake._created_lock:
+            playlist_id = spotify_id(fake._rng)
+            playlist = fake.created[playlist_id] = {
+                "id": playlist_id,
+                "name": body["name"],
+                "owner": path[1],
+                "snapshot_id": spotify_id(fake._rng),
+                "tracks": [],
+            }
+        self.send_json(201, {"id": playlist_id, "name": playlist["name"], "description": body.get("description"),
+                        "public": body.get("public", True), "snapshot_id": playlist["snapshot_id"],
+                        "uri": f"spotify:playlist:{playlist_id}", "owner": {"id": path[1]},
+                        "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+                        "tracks": {"href": f"{fake.url}/v1/playlists/{playlist_id}/tracks", "total": 0}})
+
+    def add_tracks(self, path):
+        fake = self.server_state
+        playlist = fake.created.get(path[1])
+        if path[1] in fake.playlists:
+            return self.api_error(403, "You cannot add tracks to a playlist you don't own.")
+        if playlist is None:
+            return self.api_error(404, "Not found.")
+        uris = (self.json_body() or {}).get("uris") or []
+        if len(uris) == 0 or len(uris) > 100:
+            return self.api_error(400, "You can add a maximum of 100 tracks per request.")
+        ids = [ uri.split(":")[-1] for uri in uris ]
+        if any(not uri.startswith("spotify:track:") for uri in uris) or any(i not in fake.tracks for i in ids):
+            return self.api_error(400, "Invalid track uri")
+        with fake._created_lock:
+            playlist["tracks"].extend(ids)
+            playlist["snapshot_id"] = spotify_id(fake._rng)
+            snapshot_id = playlist["snapshot_id"]
+        self.send_json(201, {"snapshot_id": snapshot_id})
+
+def add_server_arguments(parser):
+    """ Adds the FakeSpotify options to an argparse parser, shared with load_test.py """
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.02, help="extra random latency, up to this many seconds")
+    parser.add_argument("--page-size", type=int, default=100, help="maximum playlist tracks page size")
+    parser.add_argument("--playlists", type=int, default=60)
+    parser.add_argument("--tracks-per-playlist", type=int, default=250)
+    parser.add_argument("--track-pool", type=int, default=5000)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--no-device-rate", type=float, default=0.0, help="probability a queue request finds no device")
+    parser.add_argument("--seed", type=int, default=0)
+
+def server_from_arguments(args, host="127.0.0.1", port=0):
+    return FakeSpotify(host=host, port=port, latency=args.latency, jitter=args.jitter, page_size=args.page_size,
+                    playlists=args.playlists, tracks_per_playlist=args.tracks_per_playlist, track_pool=args.track_pool,
+                    rate_limit=args.rate_limit, error_rate=args.error_rate, no_device_rate=args.no_device_rate, seed=args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a fake Spotify Web API for local testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    fake = server_from_arguments(args, host=args.host, port=args.port)
+    print(f"Fake Spotify serving on {fake.start()} (set spotifyAPI.ACCOUNTS_URL to {fake.url}/api and API_URL to {fake.url}/v1)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
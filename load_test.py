@@ -0,0 +1,393 @@
+""" End-to-end load test for the Vibe Compass Dash callbacks against fake_spotify.py.
+Each simulated user runs page_load > update_playlist (picking a playlist, then polling it until done) > search_origin
+and search_destination (typing into the song dropdowns) > update_playlist (plotting a route) > send_route (queueing
+the route, or saving it as a playlist with --save), calling the callback functions directly as Dash would, and the
+harness reports throughput and latency percentiles per stage.
+
+With --traffic it runs one user through the callbacks as the browser would instead, and reports the requests and bytes
+each action costs (see Browser).
+
+Example: python load_test.py --app-module spotify.dashapps.vibe_compass_app --users 100 --iterations 3
+         python load_test.py --traffic --tracks-per-playlist 10000 --track-pool 12000
+The app's package must be importable; Django is configured with just enough settings to import it """
+
+import argparse
+import importlib
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import fake_spotify
+
+STAGES = ["page_load", "first_songs", "load_playlist", "search_songs", "plot_route", "queue_songs", "save_playlist"]
+
+# Django setup
+# reverse() is only used on error paths, so these views never need to render
+def _unused_view(request):
+    raise NotImplementedError
+
+def configure_django():
+    """ Configures just enough of Django to import the Dash app outside of the website """
+    import django
+    from django.conf import settings
+    from django.urls import path
+
+    if not settings.configured:
+        settings.configure(
+            DEBUG=False,
+            SECRET_KEY="load-test",
+            ROOT_URLCONF=__name__,
+            INSTALLED_APPS=["django.contrib.contenttypes", "django_plotly_dash"],
+            SUNFIRE_CONFIG={"VIBECOMPASS_SECRET": "load-test"},
+        )
+        django.setup()
+
+    global urlpatterns
+    urlpatterns = [
+        path("spotify/vibe-compass", _unused_view, name="vibe-compass"),
+        path("spotify/vibe-compass/error", _unused_view, name="vc-error"),
+        path("spotify/vibe-compass/spotify-error", _unused_view, name="vc-error-generic"),
+    ]
+
+@contextmanager
+def triggered(prop_id):
+    """ Makes dash.callback_context report prop_id as the triggering input, as it would inside a request """
+    import flask
+    with flask.Flask(__name__).test_request_context():
+        flask.g.triggered_inputs = [{"prop_id": prop_id, "value": None}] # dash 1.x reads the context from flask.g
+        try:
+            from dash._callback_context import context_value # dash >= 2.6 reads it from a contextvar
+            from dash._utils import AttributeDict
+        except ImportError:
+            yield
+        else:
+            token = context_value.set(AttributeDict(triggered_inputs=flask.g.triggered_inputs))
+            try:
+                yield
+            finally:
+                context_value.reset(token)
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    rank = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values)-1)]
+
+class LoadTest(object):
+    """ Runs simulated users and collects per stage timings and failures """
+
+    def __init__(self, app, steps=5, seed=0, save=False):
+        self.app = app
+        self.steps = steps
+        self.save = save # save routes as playlists instead of queueing them
+        self.timings = defaultdict(list) # stage: [seconds]
+        self.errors = defaultdict(lambda: defaultdict(int)) # stage: {exception name: count}
+        self.flows = 0
+        self._lock = threading.Lock()
+        self._seed = seed
+
+    def timed(self, stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            with self._lock:
+                self.timings[stage].append(time.perf_counter() - start)
+                self.errors[stage][type(e).__name__] += 1
+            raise
+        with self._lock:
+            self.timings[stage].append(time.perf_counter() - start)
+        return result
+
+    def user_flow(self, user, iteration):
+        """ One user picking a playlist, plotting a route and queueing or saving it """
+        import dash
+        from dash.exceptions import PreventUpdate
+
+        app = self.app
+        rng = random.Random(self._seed * 1000003 + user * 1009 + iteration)
+        session_state = {app.session_entry: f"load-test-user-{user}"}
+        try:
+            options = self.timed("page_load", app.page_load, iteration, session_state=session_state)
+            if len(options) == 0 or options[0]["value"] == "vc_error":
+                raise RuntimeError("page_load returned an error")
+            playlist_uri = rng.choice(options)["value"]
+
+            job = self.timed("load_playlist", self.load_playlist, playlist_uri, session_state)
+            origin_uri = self.timed("search_songs", self.search_song, app.search_origin, rng, job)
+            destination_uri = self.timed("search_songs", self.search_song, app.search_destination, rng, job)
+
+            with triggered("plot-route.n_clicks"):
+                outputs = self.timed("plot_route", self.update_playlist, playlist_uri, 0, 1, job, origin_uri, destination_uri, session_state)
+            if outputs["route-json.data"] is dash.no_update:
+                raise RuntimeError(outputs["load-progress.children"])
+
+            if self.save:
+                with triggered("save-playlist.n_clicks"):
+                    modal = self.timed("save_playlist", app.send_route, 0, 1, outputs["route-json.data"], session_state=session_state)
+            else:
+                with triggered("queue-playlist.n_clicks"):
+                    modal = self.timed("queue_songs", app.send_route, 1, 0, outputs["route-json.data"], session_state=session_state)
+            if getattr(modal, "className", None) == "modal-error" or type(modal).__name__ == "Location": # error redirect
+                raise RuntimeError("send_route returned an error")
+        except (PreventUpdate, Exception):
+            return False
+        with self._lock:
+            self.flows += 1
+        return True
+
+    def update_playlist(self, playlist_uri, n_intervals, n_clicks, job, origin_uri, destination_uri, session_state):
+        """ Calls update_playlist and returns its outputs by name """
+        result = self.app.update_playlist(playlist_uri, n_intervals, n_clicks, job, origin_uri, destination_uri, self.steps, None,
+                                          session_state=session_state)
+        return dict(zip(self.app.PLAYLIST_OUTPUTS, result))
+
+    def load_playlist(self, playlist_uri, session_state, poll_interval=0.05):
+        """ Picks a playlist and polls it like the load-poll interval does, until it finishes
+        Returns the final load-job, and records how long the first songs took to arrive """
+        import dash
+
+        start = time.perf_counter()
+        with triggered("playlist-selector.value"):
+            outputs = self.update_playlist(playlist_uri, None, 0, None, None, None, session_state)
+        job, songs, n_intervals = outputs["load-job.data"], False, 0
+        while True:
+            with triggered("load-poll.n_intervals"):
+                outputs = self.update_playlist(playlist_uri, n_intervals, 0, job, None, None, session_state)
+            # Songs arrive as extendData, or as a new figure of clusters for a big playlist
+            if not songs and (outputs["graph.extendData"] is not dash.no_update or outputs["graph.figure"] is not dash.no_update):
+                songs = True
+                with self._lock:
+                    self.timings["first_songs"].append(time.perf_counter() - start)
+            if outputs["load-job.data"] is not dash.no_update:
+                job = outputs["load-job.data"]
+            if outputs["load-poll.disabled"]:
+                break
+            n_intervals += 1
+            time.sleep(poll_interval)
+        message = outputs["load-progress.children"]
+        if not songs or message:
+            raise RuntimeError(message or "playlist has no songs")
+        return job
+
+    def search_song(self, search, rng, job):
+        """ Types a digit into a song dropdown with its search callback, and returns one of the songs offered """
+        with triggered("origin-song.search_value"):
+            options = search(str(rng.randrange(10)), None, None, job)
+        if not options:
+            raise RuntimeError("no songs found")
+        return rng.choice(options)["value"]
+
+    def run(self, users, iterations, concurrency):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [ pool.submit(self.user_flow, user, iteration) for iteration in range(iterations) for user in range(users) ]
+            [ future.result() for future in futures ]
+        return time.perf_counter() - start
+
+    def report(self, elapsed, attempted, server=None):
+        lines = [f"{self.flows}/{attempted} flows completed in {elapsed:.2f}s ({self.flows/elapsed:.2f} flows/s)", ""]
+        lines.append(f"{'stage':<20}{'calls':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for stage in STAGES:
+            times = self.timings[stage]
+            errors = sum(self.errors[stage].values())
+            lines.append(f"{stage:<20}{len(times):>7}{errors:>8}" + "".join(
+                f"{percentile(times, pct)*1000:>10.1f}" for pct in (50, 95, 99, 100)))
+        for stage in STAGES:
+            for name, count in sorted(self.errors[stage].items()):
+                lines.append(f"  {stage}: {count} x {name}")
+        if server is not None:
+            lines.append("")
+            lines.append("Fake Spotify requests: " + ", ".join(f"{k}={v}" for k, v in sorted(server.stats.items())))
+        return "\n".join(lines)
+
+class Browser(object):
+    """ Drives the app's callback graph the way the Dash renderer does for one open page, to measure network traffic.
+    Holds every component property, fires the callbacks a change triggers (holding one back while another callback it
+    depends on is still due), and sends each server callback the same JSON body the renderer posts to
+    _dash-update-component, through django_plotly_dash's dispatch. Bytes are the JSON request and response bodies
+    without HTTP headers, a callback that raises PreventUpdate gets an empty 204, and one that raises anything else is
+    counted as an error (a 500) and changes nothing. Clientside callbacks are counted but not run, so their outputs
+    don't change """
+
+    def __init__(self, app, session_state):
+        import plotly
+        from dash._utils import split_callback_id
+
+        self.dash_app = app.app.form_dash_instance()
+        self.session_state = session_state
+        self.encoder = plotly.utils.PlotlyJSONEncoder
+        self.callbacks = []
+        for spec in self.dash_app._callback_list:
+            outputs = split_callback_id(spec["output"])
+            self.callbacks.append({
+                "output": spec["output"], "outputs": outputs, "inputs": spec["inputs"], "state": spec["state"],
+                "clientside": spec.get("clientside_function") is not None,
+                "prevent_initial_call": spec.get("prevent_initial_call"),
+                "input_ids": { f"{i['id']}.{i['property']}" for i in spec["inputs"] },
+                "output_ids": { f"{o['id']}.{o['property']}" for o in (outputs if isinstance(outputs, list) else [outputs]) },
+            })
+        self.props = {} # "id.prop": value
+        self.collect(json.loads(json.dumps(self.dash_app._layout_value(), cls=self.encoder)))
+
+    def collect(self, node):
+        """ Records the properties of every component with an id in a JSON layout tree """
+        if isinstance(node, list):
+            for child in node:
+                self.collect(child)
+        elif isinstance(node, dict) and "props" in node:
+            props = node["props"]
+            if "id" in props:
+                self.props.update({ f"{props['id']}.{prop}": value for prop, value in props.items() if prop != "id" })
+            self.collect(props.get("children"))
+
+    def has_input(self, prop_id):
+        return any(prop_id in callback["input_ids"] for callback in self.callbacks)
+
+    def fire(self, callback, changed, totals):
+        """ Sends one callback request and applies its response. Returns the properties it changed """
+        if callback["clientside"]:
+            totals["clientside"] += 1
+            return set()
+        from dash.exceptions import PreventUpdate
+
+        def values(deps):
+            return [ dict(dep, value=self.props.get(f"{dep['id']}.{dep['property']}")) for dep in deps ]
+        body = {"output": callback["output"], "outputs": callback["outputs"], "inputs": values(callback["inputs"]),
+                "changedPropIds": sorted(changed), "state": values(callback["state"])}
+        totals["requests"] += 1
+        totals["up"] += len(json.dumps(body, cls=self.encoder))
+        arg_map = {"dash_app_id": self.dash_app._uid, "dash_app": None, "user": None, "request": None,
+                   "session_state": self.session_state}
+        try:
+            response = self.dash_app.dispatch_with_args(body, arg_map)
+        except PreventUpdate:
+            return set()
+        except Exception:
+            totals["errors"] += 1
+            return set()
+        response = getattr(response, "data", response)
+        totals["down"] += len(response)
+        updated = { f"{component}.{prop}": value for component, props in json.loads(response)["response"].items()
+                    for prop, value in props.items() }
+        self.props.update(updated)
+        return set(updated)
+
+    def run(self, pending):
+        """ Fires callbacks until nothing more is triggered. Expects {callback index: changed prop ids} """
+        totals = {"requests": 0, "clientside": 0, "errors": 0, "up": 0, "down": 0}
+        for _ in range(1000): # a loop in the callback graph would never settle
+            if not pending:
+                break
+            # The renderer holds a callback back while one that feeds its inputs is still due
+            ready = [ n for n in pending if not any(self.callbacks[m]["output_ids"] & self.callbacks[n]["input_ids"]
+                                                    for m in pending if m != n) ] or list(pending)
+            changed = set()
+            for n in ready:
+                changed |= self.fire(self.callbacks[n], pending.pop(n), totals)
+            for n, callback in enumerate(self.callbacks):
+                if changed & callback["input_ids"]:
+                    pending.setdefault(n, set()).update(changed & callback["input_ids"])
+        return totals
+
+    def open(self):
+        """ Page load: every callback fires once, in dependency order, without a triggering property """
+        return self.run({ n: set() for n, callback in enumerate(self.callbacks) if not callback["prevent_initial_call"] })
+
+    def act(self, changes):
+        """ The user (or a timer) sets properties, firing whatever they trigger """
+        self.props.update(changes)
+        return self.run({ n: set(changes) & callback["input_ids"] for n, callback in enumerate(self.callbacks)
+                        if set(changes) & callback["input_ids"] })
+
+    def poll(self, interval_id, max_polls=1000):
+        """ Ticks an Interval until a callback disables it, like the browser's timer. Returns the totals of every tick """
+        totals = {"requests": 0, "clientside": 0, "errors": 0, "up": 0, "down": 0, "ticks": 0}
+        while not self.props.get(f"{interval_id}.disabled") and totals["ticks"] < max_polls:
+            time.sleep(self.props.get(f"{interval_id}.interval", 1000) / 1000)
+            totals["ticks"] += 1
+            for key, value in self.act({f"{interval_id}.n_intervals": totals["ticks"]}).items():
+                totals[key] += value
+        return totals
+
+def measure_traffic(app, seed=0):
+    """ Runs one user through the app in a Browser and returns (action, totals) for each step """
+    rng = random.Random(seed)
+    browser = Browser(app, {app.session_entry: "traffic-user"})
+    steps = [("Open page", browser.open())]
+    steps.append(("Refresh playlists", browser.act({"refresh-playlists.n_clicks": 1})))
+    steps.append(("Select playlist", browser.act({"playlist-selector.value": browser.props["playlist-selector.options"][0]["value"]})))
+    totals = browser.poll("load-poll")
+    steps.append((f"Load playlist ({totals.pop('ticks')} polls)", totals))
+    for dropdown in ("origin-song", "destination-song"):
+        if browser.has_input(f"{dropdown}.search_value"): # typed into, rather than holding every song
+            steps.append((f"Search {dropdown}", browser.act({f"{dropdown}.search_value": str(rng.randrange(10))})))
+        options = browser.props.get(f"{dropdown}.options") or []
+        steps.append((f"Pick {dropdown}", browser.act({f"{dropdown}.value": rng.choice(options)["value"]})))
+    steps.append(("Plot route", browser.act({"plot-route.n_clicks": 1})))
+    steps.append(("Queue route", browser.act({"queue-playlist.n_clicks": 1})))
+    if browser.has_input("save-playlist.n_clicks"):
+        steps.append(("Save route", browser.act({"save-playlist.n_clicks": 1})))
+    return steps
+
+def traffic_report(steps):
+    lines = [f"{'action':<28}{'requests':>9}{'clientside':>11}{'errors':>8}{'KB up':>10}{'KB down':>10}"]
+    total = { key: sum(totals[key] for _, totals in steps) for key in ("requests", "clientside", "errors", "up", "down") }
+    for action, totals in steps + [("Total", total)]:
+        lines.append(f"{action:<28}{totals['requests']:>9}{totals['clientside']:>11}{totals['errors']:>8}"
+                     f"{totals['up']/1000:>10.1f}{totals['down']/1000:>10.1f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Vibe Compass Dash callbacks against a fake Spotify API")
+    parser.add_argument("--app-module", default="spotify.dashapps.vibe_compass_app", help="dotted path of vibe_compass_app")
+    parser.add_argument("--api-module", default=None, help="dotted path of spotifyAPI, defaults to the app's own import")
+    parser.add_argument("--users", type=int, default=50, help="number of simulated users")
+    parser.add_argument("--iterations", type=int, default=1, help="flows per user")
+    parser.add_argument("--concurrency", type=int, default=None, help="threads driving users, defaults to --users")
+    parser.add_argument("--steps", type=int, default=5, help="route steps for plot route")
+    parser.add_argument("--save", action="store_true", help="save routes as playlists instead of queueing them")
+    parser.add_argument("--server", default=None, help="use an already running fake_spotify.py at this url")
+    parser.add_argument("--traffic", action="store_true", help="measure the requests and bytes one user's actions cost instead")
+    fake_spotify.add_server_arguments(parser)
+    args = parser.parse_args(argv)
+
+    configure_django()
+    app = importlib.import_module(args.app_module)
+    api = importlib.import_module(args.api_module) if args.api_module else app.spotifyAPI
+
+    server = None
+    if args.server:
+        api.ACCOUNTS_URL = f"{args.server.rstrip('/')}/api"
+        api.API_URL = f"{args.server.rstrip('/')}/v1"
+    else:
+        server = fake_spotify.server_from_arguments(args)
+        server.start()
+        server.install(api)
+
+    if args.traffic:
+        try:
+            print(traffic_report(measure_traffic(app, args.seed)))
+        finally:
+            if server is not None:
+                server.stop()
+        return 0
+
+    test = LoadTest(app, steps=args.steps, seed=args.seed, save=args.save)
+    try:
+        elapsed = test.run(args.users, args.iterations, args.concurrency or args.users)
+    finally:
+        if server is not None:
+            server.stop()
+    print(test.report(elapsed, args.users * args.iterations, server))
+    return 0 if test.flows == args.users * args.iterations else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,97 @@
 import requests
+import httpx
 from datetime import datetime, timedelta
 import base64
+import asyncio
+import threading
+import functools
+import hashlib
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Base URLs, overridden by fake_spotify.py to point the clients at a local stand-in
+ACCOUNTS_URL = "https://accounts.spotify.com/api"
+API_URL = "https://api.spotify.com/v1"
+
+# Playlist directory cache
+# Shared by every client in this process, keyed by a hash of the user's refresh token
+DIRECTORY_TTL = 60 # seconds a user's playlist directory is reused for
+DIRECTORY_PAGE = 50 # maximum page size for me/playlists
+_directory_cache = {} # user key: (time stored, list of playlists)
+_directory_lock = threading.Lock()
+
+def user_key(refresh_token):
+    """ Returns a key for a user's cached data, so refresh tokens aren't kept as dictionary keys """
+    return hashlib.sha256(str(refresh_token).encode()).hexdigest()
+
+def cached_playlists(key, max_age=DIRECTORY_TTL):
+    """ Returns the user's cached playlist directory if it is younger than max_age seconds, else None """
+    with _directory_lock:
+        entry = _directory_cache.get(key)
+    if entry is None or time.monotonic() - entry[0] > max_age:
+        return None
+    return entry[1]
+
+def store_playlists(key, playlists):
+    """ Caches a user's playlist directory, dropping any entries that have expired """
+    now = time.monotonic()
+    with _directory_lock:
+        for stale in [ k for k, (stored, _) in _directory_cache.items() if now - stored > DIRECTORY_TTL ]:
+            del _directory_cache[stale]
+        _directory_cache[key] = (now, playlists)
+
+def forget_playlists(key):
+    """ Drops a user's cached playlist directory, ie. after they create a playlist """
+    with _directory_lock:
+        _directory_cache.pop(key, None)
+
+def playlist_is_current(key, playlistid, snapshot_id):
+    """ Compares a snapshot_id against the user's cached directory without making a request
+    Returns True/False, or None if the playlist isn't in a fresh cached directory """
+    playlists = cached_playlists(key)
+    if playlists is None:
+        return None
+    for playlist in playlists:
+        if playlist["id"] == playlistid:
+            return playlist["snapshot_id"] == snapshot_id
+    return None
+
+def directory_entry(item):
+    """ Converts a simplified playlist object from me/playlists into a directory entry """
+    return {"name": item["name"], "id": item["id"], "snapshot_id": item.get("snapshot_id"), "tracks": item["tracks"]["total"]}
+
+# Saving playlists
+PLAYLIST_ADD_BATCH = 100 # most track uris Spotify adds to a playlist per request
+_user_ids = {} # user key: spotify user id, looked up once as it never changes
+
+def token_request(client_creds, accref_code, refresh=False):
+    """ Expects client credentials and an access_code or refresh_token
+    Returns the url, headers and params for a token request """
+    url = f"{ACCOUNTS_URL}/token"
+    token_payload = {
+        "grant_type":"authorization_code" if not refresh else "refresh_token",
+        "code" if not refresh else "refresh_token" : accref_code,
+        "redirect_uri": "https://sunfire.xyz/spotify/vibe-compass", # there is no redirect, used for validation only
+    }
+
+    # Encode client credentials as base64 for added security
+    client_creds_b64 = base64.b64encode(client_creds.encode())
+    token_headers = {
+        "Authorization": f"Basic {client_creds_b64.decode()}",
+        'Content-Type':"application/x-www-form-urlencoded",
+    }
+    return url, token_headers, token_payload
 
 class Client(object):
     def __init__(self, client_creds, accref_code, refresh=False):
         self.client_creds = client_creds
         if refresh == False: # First time authentication
             self.authenticate(accref_code)
+            self.user_key = user_key(self.refresh_token)
         else: # Refresh authentication
             self.refresh_token = accref_code
+            self.user_key = user_key(accref_code) # the token held in the session, in case Spotify rotates it
             self.authenticate(accref_code, refresh=True)
         self.user_playlists = []
 
@@ -24,19 +107,7 @@ class Client(object):
         """ Expects an access_code or refresh_token
         Updates class access_token, refresh_token and expiry
         Returns True if successful, else False """
-        url = "https://accounts.spotify.com/api/token"
-        token_payload = {
-            "grant_type":"authorization_code" if not refresh else "refresh_token",
-            "code" if not refresh else "refresh_token" : accref_code,
-            "redirect_uri": "https://sunfire.xyz/spotify/vibe-compass", # there is no redirect, used for validation only
-        }
-
-        # Encode client credentials as base64 for added security
-        client_creds_b64 = base64.b64encode(self.client_creds.encode())
-        token_headers = {
-            "Authorization": f"Basic {client_creds_b64.decode()}",
-            'Content-Type':"application/x-www-form-urlencoded",
-        }
+        url, token_headers, token_payload = token_request(self.client_creds, accref_code, refresh)
 
         # Make Request
         r = requests.post(url, headers=token_headers, params=token_payload)
@@ -63,58 +134,108 @@ class Client(object):
         
     @reauthenticate
     def get_track(self, trackid):
-        """ Expects a single track ID or a list of track IDs and returns audio parameters as json """
+        """ Expects a single track ID or a list of track IDs and returns track details as json
+        Lookups are coalesced with other sessions' by track_loader """
         if type(trackid) == list:
-            requeststring = ",".join(trackid) # convert list to string separated by commas
+            return {"tracks": track_loader.load_many(self, trackid).result()}
         elif type(trackid) == str:
-            requeststring = trackid
-            
-        url = f"https://api.spotify.com/v1/tracks/{requeststring}"
-        r = requests.get(url, headers=self.default_json_header)
-        if self.status_code_check(r):
-            return r.json()
+            return track_loader.load_many(self, [trackid]).result()[0]
 
     @reauthenticate            
-    def get_playlist(self, playlistid, market="from_token"):
-        """ Gets tracks from a playlist from its URI """
-        url = f"https://api.spotify.com/v1/playlists/{playlistid}/tracks?market={market}"
+    def get_playlist(self, playlistid, market="from_token", offset=0, limit=100):
+        """ Gets a page of tracks from a playlist from its URI, 100 tracks is the most Spotify returns at once """
+        url = f"{API_URL}/playlists/{playlistid}/tracks?market={market}&offset={offset}&limit={limit}"
         r = requests.get(url, headers=self.default_json_header)
         if self.status_code_check(r):
             return r.json()
 
     @reauthenticate
-    def get_users_playlists(self):
-        """ Gets a list of all the users public and private playlists """
-        url = "https://api.spotify.com/v1/me/playlists?limit=50"
+    def get_users_playlists(self, max_age=DIRECTORY_TTL):
+        """ Gets a list of all the users public and private playlists, with their snapshot_id and track count
+        The directory is cached per user for max_age seconds, pass max_age=0 to force a reload """
+        cached = cached_playlists(self.user_key, max_age)
+        if cached is not None:
+            self.user_playlists = cached
+            return self.user_playlists
+
+        # The first page tells us how many playlists there are, then fetch the rest at once
+        first_page = self.get_playlists_page(0)
+        offsets = range(DIRECTORY_PAGE, first_page["total"], DIRECTORY_PAGE)
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            pages = [first_page] + list(pool.map(self.get_playlists_page, offsets))
+
+        self.user_playlists = [ directory_entry(item) for page in pages for item in page["items"] ]
+        store_playlists(self.user_key, self.user_playlists)
+        return self.user_playlists
 
+    def get_playlists_page(self, offset):
+        """ Gets one page of the user's playlists as json """
+        url = f"{API_URL}/me/playlists?limit={DIRECTORY_PAGE}&offset={offset}"
         r = requests.get(url, headers=self.default_json_header)
         if self.status_code_check(r):
-            self.user_playlists = []
-            [ self.user_playlists.append({"name": item["name"], "id" : item["id"]}) for item in r.json()["items"] ]
-        return self.user_playlists
+            return r.json()
+
+    def is_current(self, playlistid, snapshot_id):
+        """ Returns True if snapshot_id matches the user's cached playlist directory, None if it isn't cached """
+        return playlist_is_current(self.user_key, playlistid, snapshot_id)
     
     @reauthenticate
     def queue_song(self, trackid):
-        url = f"https://api.spotify.com/v1/me/player/queue?uri=spotify:track:{trackid}"
+        url = f"{API_URL}/me/player/queue?uri=spotify:track:{trackid}"
         r = requests.post(
             url,
             headers={'Authorization': f'Bearer {self.access_token}'}
         )
         self.status_code_check(r) # we don't get json from a post request so can't do this
         return r
-    
+
     @reauthenticate
-    def get_parameters(self, trackids):
-        """ Expects a single track ID or a list of track IDs and returns audio parameters as json """
-        if type(trackids) == list:
-            requeststring = ",".join(trackids) # convert list to string separated by commas
-        elif type(trackids) == str:
-            requeststring = trackids
-        url = f"https://api.spotify.com/v1/audio-features?ids={requeststring}"
-        r = requests.get(url, headers=self.default_json_header)
+    def get_user_id(self):
+        """ Returns the user's spotify id, which creating playlists needs """
+        user_id = _user_ids.get(self.user_key)
+        if user_id is None:
+            r = requests.get(f"{API_URL}/me", headers=self.default_json_header)
+            if self.status_code_check(r):
+                user_id = _user_ids[self.user_key] = r.json()["id"]
+        return user_id
+
+    @reauthenticate
+    def create_playlist(self, name, description="", public=False):
+        """ Creates an empty playlist for the user and returns it as json """
+        url = f"{API_URL}/users/{self.get_user_id()}/playlists"
+        r = requests.post(url, headers=self.default_json_header, json={"name": name, "description": description, "public": public})
         if self.status_code_check(r):
+            forget_playlists(self.user_key) # so the new playlist shows up in the directory
             return r.json()
 
+    @reauthenticate
+    def add_to_playlist(self, playlistid, trackids):
+        """ Expects a playlist ID and a list of track IDs, and adds the tracks to the end of the playlist
+        in requests of up to PLAYLIST_ADD_BATCH tracks. Returns the playlist's new snapshot_id """
+        url = f"{API_URL}/playlists/{playlistid}/tracks"
+        uris = [ f"spotify:track:{trackid}" for trackid in trackids ]
+        snapshot_id = None
+        for n in range(0, len(uris), PLAYLIST_ADD_BATCH): # one request at a time so the tracks keep their order
+            r = requests.post(url, headers=self.default_json_header, json={"uris": uris[n:n+PLAYLIST_ADD_BATCH]})
+            if self.status_code_check(r):
+                snapshot_id = r.json()["snapshot_id"]
+        return snapshot_id
+
+    def save_playlist(self, name, trackids, description="", public=False):
+        """ Creates a playlist holding the tracks, ie. a route. Unlike queue_song this needs no active device
+        Returns the new playlist as json """
+        playlist = self.create_playlist(name, description, public)
+        playlist["snapshot_id"] = self.add_to_playlist(playlist["id"], trackids) or playlist["snapshot_id"]
+        return playlist
+    
+    @reauthenticate
+    def get_parameters(self, trackids):
+        """ Expects a single track ID or a list of track IDs and returns audio parameters as json
+        Lookups are coalesced with other sessions' by features_loader """
+        if type(trackids) == str:
+            trackids = [trackids]
+        return {"audio_features": features_loader.load_many(self, trackids).result()}
+
     @staticmethod
     def status_code_check(response):
         status_code = response.status_code
@@ -143,6 +264,388 @@ class Client(object):
                 # Any generic errors
                 raise InvalidRequest(status_code, error_msg)
 
+class AsyncClient(object):
+    """ asyncio version of Client, with the same methods as coroutines.
+    Create it with `await AsyncClient.create(...)`, or `AsyncClient.create_sync(...)` from a Dash callback """
+
+    def __init__(self, client_creds, http=None):
+        self.client_creds = client_creds
+        self.user_playlists = []
+        self._http = http # share one httpx.AsyncClient between users to pool connections
+        self._owns_http = http is None
+        self._auth_lock = None # created lazily so it is bound to the running loop
+
+    @classmethod
+    async def create(cls, client_creds, accref_code, refresh=False, http=None):
+        """ Async equivalent of Client(client_creds, accref_code, refresh) """
+        self = cls(client_creds, http=http)
+        if refresh == False: # First time authentication
+            await self.authenticate(accref_code)
+            self.user_key = user_key(self.refresh_token)
+        else: # Refresh authentication
+            self.refresh_token = accref_code
+            self.user_key = user_key(accref_code)
+            await self.authenticate(accref_code, refresh=True)
+        return self
+
+    @classmethod
+    def create_sync(cls, client_creds, accref_code, refresh=False, http=None):
+        """ Creates a client on the shared background event loop, for use from synchronous code """
+        return run_sync(cls.create(client_creds, accref_code, refresh=refresh, http=http))
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=100))
+        return self._http
+
+    @property
+    def default_json_header(self):
+        return {
+                'Accept':'application/json',
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {self.access_token}'
+                }
+
+    async def aclose(self):
+        """ Closes the underlying connection pool if this client created it """
+        if self._owns_http and self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def authenticate(self, accref_code, refresh=False):
+        """ Expects an access_code or refresh_token
+        Updates class access_token, refresh_token and expiry
+        Returns True if successful, else False """
+        url, token_headers, token_payload = token_request(self.client_creds, accref_code, refresh)
+
+        # Make Request
+        r = await self.http.post(url, headers=token_headers, params=token_payload)
+        if Client.status_code_check(r):
+            expiry = datetime.now() + timedelta(seconds=r.json()["expires_in"])
+            self.access_token = r.json()["access_token"]
+            self.expiry = expiry
+            if "refresh_token" in r.json(): # if we're refreshing, we won't get a refresh token
+                self.refresh_token = r.json()["refresh_token"]
+            return True
+        else:
+            return False
+
+    def reauthenticate(fn):
+        """ Decorator function to ensure access/refresh tokens are fresh
+        Concurrent calls share a lock so only one of them refreshes the token """
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            if datetime.now() >= self.expiry: # Reauthentication required
+                if self._auth_lock is None:
+                    self._auth_lock = asyncio.Lock()
+                async with self._auth_lock:
+                    if datetime.now() >= self.expiry: # another call may have refreshed while we waited
+                        await self.authenticate(self.refresh_token, refresh=True)
+            return await fn(self, *args, **kwargs)
+        return wrapper
+
+    @reauthenticate
+    async def get_track(self, trackid):
+        """ Expects a single track ID or a list of track IDs and returns track details as json
+        Lookups are coalesced with other sessions' by track_loader """
+        if type(trackid) == list:
+            return {"tracks": await track_loader.load_many_async(self, trackid)}
+        elif type(trackid) == str:
+            return (await track_loader.load_many_async(self, [trackid]))[0]
+
+    @reauthenticate
+    async def get_playlist(self, playlistid, market="from_token", offset=0, limit=100):
+        """ Gets a page of tracks from a playlist from its URI, 100 tracks is the most Spotify returns at once """
+        url = f"{API_URL}/playlists/{playlistid}/tracks?market={market}&offset={offset}&limit={limit}"
+        r = await self.http.get(url, headers=self.default_json_header)
+        if Client.status_code_check(r):
+            return r.json()
+
+    @reauthenticate
+    async def get_users_playlists(self, max_age=DIRECTORY_TTL):
+        """ Gets a list of all the users public and private playlists, with their snapshot_id and track count
+        The directory is cached per user for max_age seconds, pass max_age=0 to force a reload """
+        cached = cached_playlists(self.user_key, max_age)
+        if cached is not None:
+            self.user_playlists = cached
+            return self.user_playlists
+
+        # The first page tells us how many playlists there are, then fetch the rest at once
+        first_page = await self.get_playlists_page(0)
+        offsets = range(DIRECTORY_PAGE, first_page["total"], DIRECTORY_PAGE)
+        pages = [first_page] + list(await asyncio.gather(*[ self.get_playlists_page(offset) for offset in offsets ]))
+
+        self.user_playlists = [ directory_entry(item) for page in pages for item in page["items"] ]
+        store_playlists(self.user_key, self.user_playlists)
+        return self.user_playlists
+
+    async def get_playlists_page(self, offset):
+        """ Gets one page of the user's playlists as json """
+        url = f"{API_URL}/me/playlists?limit={DIRECTORY_PAGE}&offset={offset}"
+        r = await self.http.get(url, headers=self.default_json_header)
+        if Client.status_code_check(r):
+            return r.json()
+
+    def is_current(self, playlistid, snapshot_id):
+        """ Returns True if snapshot_id matches the user's cached playlist directory, None if it isn't cached """
+        return playlist_is_current(self.user_key, playlistid, snapshot_id)
+
+    @reauthenticate
+    async def queue_song(self, trackid):
+        url = f"{API_URL}/me/player/queue?uri=spotify:track:{trackid}"
+        r = await self.http.post(
+            url,
+            headers={'Authorization': f'Bearer {self.access_token}'}
+        )
+        Client.status_code_check(r)
+        return r
+
+    @reauthenticate
+    async def get_user_id(self):
+        """ Returns the user's spotify id, which creating playlists needs """
+        user_id = _user_ids.get(self.user_key)
+        if user_id is None:
+            r = await self.http.get(f"{API_URL}/me", headers=self.default_json_header)
+            if Client.status_code_check(r):
+                user_id = _user_ids[self.user_key] = r.json()["id"]
+        return user_id
+
+    @reauthenticate
+    async def create_playlist(self, name, description="", public=False):
+        """ Creates an empty playlist for the user and returns it as json """
+        url = f"{API_URL}/users/{await self.get_user_id()}/playlists"
+        r = await self.http.post(url, headers=self.default_json_header, json={"name": name, "description": description, "public": public})
+        if Client.status_code_check(r):
+            forget_playlists(self.user_key) # so the new playlist shows up in the directory
+            return r.json()
+
+    @reauthenticate
+    async def add_to_playlist(self, playlistid, trackids):
+        """ Expects a playlist ID and a list of track IDs, and adds the tracks to the end of the playlist
+        in requests of up to PLAYLIST_ADD_BATCH tracks. Returns the playlist's new snapshot_id """
+        url = f"{API_URL}/playlists/{playlistid}/tracks"
+        uris = [ f"spotify:track:{trackid}" for trackid in trackids ]
+        snapshot_id = None
+        for n in range(0, len(uris), PLAYLIST_ADD_BATCH): # one request at a time so the tracks keep their order
+            r = await self.http.post(url, headers=self.default_json_header, json={"uris": uris[n:n+PLAYLIST_ADD_BATCH]})
+            if Client.status_code_check(r):
+                snapshot_id = r.json()["snapshot_id"]
+        return snapshot_id
+
+    async def save_playlist(self, name, trackids, description="", public=False):
+        """ Creates a playlist holding the tracks, ie. a route. Unlike queue_song this needs no active device
+        Returns the new playlist as json """
+        playlist = await self.create_playlist(name, description, public)
+        playlist["snapshot_id"] = await self.add_to_playlist(playlist["id"], trackids) or playlist["snapshot_id"]
+        return playlist
+
+    @reauthenticate
+    async def get_parameters(self, trackids):
+        """ Expects a single track ID or a list of track IDs and returns audio parameters as json
+        Lookups are coalesced with other sessions' by features_loader """
+        if type(trackids) == str:
+            trackids = [trackids]
+        return {"audio_features": await features_loader.load_many_async(self, trackids)}
+
+    def sync(self, coro, timeout=None):
+        """ Runs one of this client's coroutines from synchronous code, ie. sp.sync(sp.get_playlist(uri)) """
+        return run_sync(coro, timeout=timeout)
+
+# Request coalescing
+class BatchLoader(object):
+    """ Collects id lookups from every session over a short window, removes duplicates and fetches them
+    with as few bulk requests as possible, then hands each caller the results for its own ids.
+    Track and audio feature data is the same for every user, so any waiting client's token can fetch it.
+    Client lookups are fetched with requests on a thread pool, AsyncClient lookups are batched per event loop
+    and fetched with the loaders' own httpx pool for that loop (see loader_http), both with the same resolve logic """
+
+    def __init__(self, path, key, chunk_size, window=0.01):
+        self.path = path # endpoint taking ?ids=
+        self.key = key # list of results in the response json
+        self.chunk_size = chunk_size # most ids Spotify accepts per request
+        self.window = window # seconds to wait for other lookups before fetching
+        self._waiting = [] # (client, ids, future)
+        self._timer = None
+        self._async_waiting = {} # event loop: [(client, ids, asyncio future)]
+        self._tasks = set() # async flushes in progress, so they aren't garbage collected
+        self._lock = threading.Lock()
+
+    def load_many(self, client, ids):
+        """ Expects a client (for its access token) and a list of ids
+        Returns a concurrent.futures.Future of the results in the same order, None for unknown ids """
+        future = Future()
+        if len(ids) == 0:
+            future.set_result([])
+            return future
+        with self._lock:
+            self._waiting.append((client, list(ids), future))
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    async def load_many_async(self, client, ids):
+        """ load_many for an AsyncClient: waits without blocking the event loop and returns the results """
+        if len(ids) == 0:
+            return []
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            waiting = self._async_waiting.setdefault(loop, [])
+            waiting.append((client, list(ids), future))
+            if len(waiting) == 1:
+                loop.call_later(self.window, self._start_async_flush, loop)
+        return await future
+
+    def flush(self):
+        """ Fetches everything waiting from Client callers """
+        with self._lock:
+            waiting, self._waiting = self._waiting, []
+            self._timer = None
+        asyncio.run(self.resolve(waiting, self.attempt_in_pool))
+
+    def _start_async_flush(self, loop):
+        with self._lock:
+            waiting = self._async_waiting.pop(loop, [])
+        task = loop.create_task(self.resolve(waiting, self.attempt_async))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def resolve(self, waiting, attempt):
+        """ Fetches the ids waiting with attempt(client, ids), and hands each caller its results or the error its own
+        ids caused. If a client's token fails, only its own callers get the error and the rest are retried with the
+        next client """
+        found = {} # id: item, or None if Spotify doesn't know it
+        errors = {} # future: exception for that caller alone
+        for client in list(dict.fromkeys(c for c, _, _ in waiting)):
+            pending = [ w for w in waiting if w[2] not in errors ]
+            missing = list(dict.fromkeys(i for _, ids, _ in pending for i in ids if i not in found)) # keeps order
+            if not missing:
+                break
+            chunks = [ missing[n:n+self.chunk_size] for n in range(0, len(missing), self.chunk_size) ]
+            token_failed = False
+            for chunk, outcome in zip(chunks, await asyncio.gather(*[ attempt(client, chunk) for chunk in chunks ])):
+                if not isinstance(outcome, Exception):
+                    found.update(self.by_id(chunk, outcome))
+                elif auth_failed(outcome): # this client's token, so another client can fetch the rest
+                    token_failed = True
+                    errors.update({ future: outcome for c, _, future in pending if c is client })
+                elif isinstance(outcome, InvalidRequest) and outcome.status_code == 400:
+                    await self.split(client, chunk, outcome, pending, found, errors, attempt)
+                else: # rate limits and server errors affect everyone, so fail the chunk's callers rather than retry
+                    errors.update({ future: outcome for _, ids, future in pending if not set(ids).isdisjoint(chunk) })
+            if not token_failed:
+                break
+
+        for _, ids, future in waiting:
+            if future.done(): # an async caller that has been cancelled
+                continue
+            if future in errors:
+                future.set_exception(errors[future])
+            else:
+                future.set_result([ found.get(i) for i in ids ])
+
+    async def split(self, client, chunk, error, pending, found, errors, attempt):
+        """ A bad request for a chunk several callers share is refetched per caller, so only the caller
+        that sent the bad id gets the error """
+        callers = [ (ids, future) for _, ids, future in pending if future not in errors and not set(ids).isdisjoint(chunk) ]
+        if len(callers) == 1:
+            errors[callers[0][1]] = error
+            return
+        for ids, future in callers:
+            own = [ i for i in dict.fromkeys(ids) if i in chunk and i not in found ]
+            if len(own) == 0:
+                continue
+            outcome = await attempt(client, own)
+            if isinstance(outcome, Exception):
+                errors[future] = outcome
+            else:
+                found.update(self.by_id(own, outcome))
+
+    @staticmethod
+    def by_id(chunk, items):
+        """ Matches results to the requested ids by each item's own id, None for ids Spotify didn't return """
+        results = dict.fromkeys(chunk)
+        results.update({ item["id"]: item for item in items if item is not None and item.get("id") in results })
+        return results
+
+    def url(self, ids):
+        return f"{API_URL}/{self.path}?ids={','.join(ids)}"
+
+    async def attempt_in_pool(self, client, ids):
+        """ One bulk request with requests on the loader pool, returning the exception rather than raising it """
+        return await asyncio.get_running_loop().run_in_executor(_loader_pool, self.attempt, client, ids)
+
+    def attempt(self, client, ids):
+        try:
+            r = requests.get(self.url(ids), headers=client.default_json_header)
+            if Client.status_code_check(r):
+                return r.json()[self.key]
+        except Exception as e:
+            return e
+
+    async def attempt_async(self, client, ids):
+        """ One bulk request with an AsyncClient's token, returning the exception rather than raising it """
+        try:
+            r = await loader_http().get(self.url(ids), headers=client.default_json_header)
+            if Client.status_code_check(r):
+                return r.json()[self.key]
+        except Exception as e:
+            return e
+
+def auth_failed(error):
+    """ True if an error is down to the client's own token rather than the request """
+    return isinstance(error, (AccessRevoked, InvalidAuthorisation)) or (isinstance(error, InvalidRequest) and error.status_code == 401)
+
+_loader_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="spotify-loader")
+_loader_http = weakref.WeakKeyDictionary() # event loop: httpx.AsyncClient
+_loader_http_lock = threading.Lock()
+
+def loader_http():
+    """ Returns the loaders' httpx pool for the running event loop. A batch mixes several sessions' lookups,
+    so borrowing one caller's pool would fail all of them when that session closes its client """
+    loop = asyncio.get_running_loop()
+    with _loader_http_lock:
+        http = _loader_http.get(loop)
+        if http is None or http.is_closed:
+            http = _loader_http[loop] = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=100))
+    return http
+
+track_loader = BatchLoader("tracks", "tracks", 50)
+features_loader = BatchLoader("audio-features", "audio_features", 100)
+
+# Sync bridge
+# Dash callbacks are synchronous, so coroutines are handed to one event loop running in a daemon thread.
+# A callback blocks on its own result while the loop interleaves every request in flight across all callbacks.
+_bridge_loop = None
+_bridge_lock = threading.Lock()
+
+def bridge_loop():
+    """ Returns the shared background event loop, starting it on first use """
+    global _bridge_loop
+    with _bridge_lock:
+        if _bridge_loop is None or _bridge_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="spotify-async-bridge", daemon=True)
+            thread.start()
+            _bridge_loop = loop
+    return _bridge_loop
+
+def run_sync(coro, timeout=None):
+    """ Expects a coroutine
+    Runs it on the shared background loop and blocks until it returns or raises """
+    future = asyncio.run_coroutine_threadsafe(coro, bridge_loop())
+    return future.result(timeout)
+
+def gather_sync(*coros, timeout=None, return_exceptions=False):
+    """ Expects coroutines
+    Runs them concurrently on the background loop and returns their results in order """
+    async def gather():
+        return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+    return run_sync(gather(), timeout=timeout)
+
 # Custom Exceptions
 class InvalidRequest(Exception):
     """ Raise exception if an API call does not result in a successful response """
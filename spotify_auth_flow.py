@@ -33,7 +33,7 @@ def authentication_flow(request, app_parameters, dash_app=False):
         request.session["csrf_str"] = csrf_str # save to user's session data
         csrf_tok = sha256_encrypt(csrf_str)
 
-        scope="user-modify-playback-state%20playlist-read-private%20playlist-read-collaborative" # permissions to queue songs, read playlists
+        scope="user-modify-playback-state%20playlist-read-private%20playlist-read-collaborative%20playlist-modify-private%20playlist-modify-public" # permissions to queue songs, read and save playlists
         spotify_auth_url = f"https://accounts.spotify.com/authorize?client_id={client_id}&response_type=code&redirect_uri={redirect_uri}&scope={scope}&state={csrf_tok}"
         return redirect(spotify_auth_url)
     else: # User has agreed and been redirected from spotify
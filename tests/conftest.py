@@ -0,0 +1,19 @@
+""" Makes the repository importable as the package it is deployed in, spotifyAPI in spotify and the Vibe Compass
+modules in spotify.dashapps, so their relative imports resolve without a Django project around them """
+import importlib.util
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _package(name):
+    package = types.ModuleType(name)
+    package.__path__ = [ROOT]
+    sys.modules[name] = package
+    return package
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT) # fake_spotify and load_test are imported as top level modules
+if importlib.util.find_spec("spotify") is None:
+    _package("spotify").dashapps = _package("spotify.dashapps")
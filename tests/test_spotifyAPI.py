@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+
+import fake_spotify
+from spotify import spotifyAPI
+
+@pytest.fixture(scope="module")
+def fake():
+    fake = fake_spotify.FakeSpotify(latency=0.05, track_pool=500)
+    fake.start()
+    fake.install(spotifyAPI)
+    yield fake
+    fake.stop()
+
+def lookup(loader, waiting, attempt):
+    """ Runs loader.resolve on (client, ids) pairs with a stand-in attempt, returning each caller's result or error """
+    async def run():
+        loop = asyncio.get_running_loop()
+        futures = [ (client, ids, loop.create_future()) for client, ids in waiting ]
+        await loader.resolve(futures, attempt)
+        return [ future.exception() or future.result() for _, _, future in futures ]
+    return asyncio.run(run())
+
+def items(ids):
+    return [ {"id": i} for i in ids ]
+
+def test_resolve_dedupes_and_chunks():
+    calls = []
+    async def attempt(client, ids):
+        calls.append(ids)
+        return items(i for i in ids if i != "unknown")
+
+    loader = spotifyAPI.BatchLoader("tracks", "tracks", chunk_size=3)
+    results = lookup(loader, [("a", ["1", "2", "3"]), ("b", ["3", "4", "unknown"]), ("a", ["2"])], attempt)
+
+    assert calls == [["1", "2", "3"], ["4", "unknown"]]
+    assert results == [items(["1", "2", "3"]), items(["3", "4"]) + [None], items(["2"])]
+
+def test_resolve_retries_with_next_client_when_a_token_fails():
+    calls = []
+    async def attempt(client, ids):
+        calls.append(client)
+        if client == "revoked":
+            return spotifyAPI.InvalidRequest(401, "The access token expired")
+        return items(ids)
+
+    loader = spotifyAPI.BatchLoader("tracks", "tracks", chunk_size=50)
+    results = lookup(loader, [("revoked", ["1", "2"]), ("ok", ["2", "3"])], attempt)
+
+    assert calls == ["revoked", "ok"]
+    assert isinstance(results[0], spotifyAPI.InvalidRequest) and results[0].status_code == 401
+    assert results[1] == items(["2", "3"])
+
+def test_resolve_splits_a_bad_request_between_callers():
+    async def attempt(client, ids):
+        if "bad" in ids:
+            return spotifyAPI.InvalidRequest(400, "invalid id")
+        return items(ids)
+
+    loader = spotifyAPI.BatchLoader("tracks", "tracks", chunk_size=50)
+    results = lookup(loader, [("a", ["1", "2"]), ("b", ["2", "bad"]), ("c", ["3"])], attempt)
+
+    assert results[0] == items(["1", "2"])
+    assert isinstance(results[1], spotifyAPI.InvalidRequest) and results[1].status_code == 400
+    assert results[2] == items(["3"])
+
+def test_resolve_fails_only_the_callers_of_a_failed_chunk():
+    async def attempt(client, ids):
+        if "1" in ids:
+            return spotifyAPI.InvalidRequest(500, "Server error")
+        return items(ids)
+
+    loader = spotifyAPI.BatchLoader("tracks", "tracks", chunk_size=2)
+    results = lookup(loader, [("a", ["1", "2"]), ("b", ["3", "4"])], attempt)
+
+    assert isinstance(results[0], spotifyAPI.InvalidRequest) and results[0].status_code == 500
+    assert results[1] == items(["3", "4"])
+
+def test_sync_lookups_share_a_request(fake):
+    ids = list(fake.tracks)
+    clients = [ spotifyAPI.Client("a:b", f"user{n}", refresh=True) for n in range(3) ]
+    before = fake.stats["tracks"]
+
+    futures = [ spotifyAPI.track_loader.load_many(client, ids[n*10:n*10+20]) for n, client in enumerate(clients) ]
+
+    assert [ [ t["id"] for t in future.result(10) ] for future in futures ] == [ ids[n*10:n*10+20] for n in range(3) ]
+    assert fake.stats["tracks"] - before == 1
+
+def test_async_lookup_survives_another_client_closing(fake):
+    ids = list(fake.tracks)
+    async def run():
+        first = await spotifyAPI.AsyncClient.create("a:b", "first", refresh=True)
+        second = await spotifyAPI.AsyncClient.create("a:b", "second", refresh=True)
+        async def close_first():
+            await asyncio.sleep(spotifyAPI.features_loader.window + 0.02) # while the batch is in flight
+            await first.aclose()
+        results = await asyncio.gather(first.get_parameters(ids[:5]), second.get_parameters(ids[5:10]), close_first(),
+                                       return_exceptions=True)
+        await second.aclose()
+        return results
+    first, second, _ = asyncio.run(run())
+    assert [ f["id"] for f in second["audio_features"] ] == ids[5:10]
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from spotify.dashapps import vc_linalg
+
+def brute_force_cones(features, stops, radius, angle):
+    """ Every song checked against every stop, what song_cones computes without the path bounds """
+    bearing = (stops[-1] - stops[0]) / np.linalg.norm(stops[-1] - stops[0])
+    cones = []
+    for n in range(1, len(stops)):
+        from_apex = features - stops[n-1]
+        within_radius = np.linalg.norm(features - stops[n], axis=1) <= radius
+        in_cone = from_apex @ bearing >= np.cos(np.radians(angle)) * np.linalg.norm(from_apex, axis=1)
+        cones.append(np.where(within_radius & in_cone)[0])
+    return cones
+
+@pytest.mark.parametrize("steps", [1, 5, 20])
+@pytest.mark.parametrize("radius, angle", [(0.15, 60), (0.3, 30)])
+def test_song_cones_match_brute_force(steps, radius, angle):
+    rng = np.random.default_rng(steps)
+    features = rng.random((5000, 3))
+    origin, destination = rng.choice(len(features), 2, replace=False)
+    stops = vc_linalg.get_direct_path(features, origin, destination, steps)
+
+    cones = vc_linalg.song_cones(features, stops, radius, angle)
+
+    assert len(cones) == steps
+    for cone, expected in zip(cones, brute_force_cones(features, stops, radius, angle)):
+        np.testing.assert_array_equal(cone, expected)
+
+def test_song_cones_same_origin_and_destination():
+    features = np.array([[0.5, 0.5, 0.5], [0.55, 0.5, 0.5], [0.9, 0.9, 0.9]])
+    stops = vc_linalg.get_direct_path(features, 0, 0, 3)
+    for cone in vc_linalg.song_cones(features, stops):
+        np.testing.assert_array_equal(cone, [0, 1])
+
+def test_ahead_of():
+    features = np.array([[0.0, 0.0, 0.0], [0.2, 0.0, 0.0], [0.4, 0.1, 0.0], [0.1, 0.5, 0.5]])
+    bearing = np.array([1.0, 0.0, 0.0])
+    np.testing.assert_array_equal(vc_linalg.ahead_of(features, [0, 1, 2, 3], features[1], bearing), [2])
+    np.testing.assert_array_equal(vc_linalg.ahead_of(features, [0, 1, 2, 3], features[1], np.zeros(3)), [0, 1, 2, 3])
+
+def test_route_does_not_double_back():
+    rng = np.random.default_rng(0)
+    features = rng.random((20000, 3))
+    for _ in range(50):
+        origin, destination = rng.choice(len(features), 2, replace=False)
+        stops, playlist = vc_linalg.route_features(features, origin, destination, 20)
+        along = (features[playlist[:-1]] - stops[0]) @ (stops[-1] - stops[0]) # the last move is to the destination
+        assert playlist[0] == origin and playlist[-1] == destination
+        assert np.all(np.diff(along) > 0)
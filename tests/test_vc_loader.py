@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+pytest.importorskip("django")
+import fake_spotify
+import load_test
+
+load_test.configure_django()
+from spotify import spotifyAPI
+from spotify.dashapps import vc_loader, vc_shared
+
+@pytest.fixture(autouse=True)
+def catalog_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(vc_shared, "CATALOG_DIR", str(tmp_path))
+
+@pytest.fixture
+def fake(request):
+    fake = fake_spotify.FakeSpotify(**request.param)
+    fake.start()
+    fake.install(spotifyAPI)
+    yield fake
+    fake.stop()
+
+def load(playlist_id, timeout=30):
+    job_id = vc_loader.start_load("client:secret", "user", playlist_id)
+    deadline = time.monotonic() + timeout
+    while vc_loader.load_progress(job_id)["status"] == "loading" and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return job_id, vc_loader.load_progress(job_id)
+
+@pytest.mark.parametrize("fake", [dict(latency=0.01, page_size=50, playlists=1, tracks_per_playlist=400, track_pool=1000)],
+                         indirect=True)
+def test_load_follows_the_page_size_the_api_sends(fake):
+    playlist = next(iter(fake.playlists.values()))
+
+    job_id, progress = load(playlist["id"])
+
+    assert progress["status"] == "done"
+    assert progress["loaded"] == progress["total"] == 400
+    assert vc_loader.load_rows(job_id, 0, progress["pages"])["spotify_id"] == playlist["tracks"]
+
+@pytest.mark.parametrize("fake", [dict(latency=0.01, playlists=1, tracks_per_playlist=250, track_pool=1000)], indirect=True)
+def test_labels_index_matches_the_rows(fake):
+    playlist = next(iter(fake.playlists.values()))
+
+    job_id, progress = load(playlist["id"])
+
+    rows = vc_loader.load_rows(job_id, 0, progress["pages"])
+    labels = vc_loader.load_labels(job_id)
+    assert labels["ids"] == rows["spotify_id"]
+    assert labels["labels"] == [ f"{artist} - {title}" for artist, title in zip(rows["artist"], rows["track_title"]) ]
+
+@pytest.mark.parametrize("fake", [dict(latency=0.0, jitter=0.05, page_size=20, playlists=1, tracks_per_playlist=300,
+                                       track_pool=1000)], indirect=True)
+def test_pages_are_appended_in_playlist_order(fake):
+    playlist = next(iter(fake.playlists.values()))
+
+    loads = [ load(playlist["id"]) for _ in range(2) ] # pages arrive in a different order each time
+
+    for job_id, progress in loads:
+        assert progress["status"] == "done"
+        assert vc_loader.load_rows(job_id, 0, progress["pages"])["spotify_id"] == playlist["tracks"]
+    assert loads[0][1]["catalog"] == loads[1][1]["catalog"]
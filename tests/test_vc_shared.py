@@ -0,0 +1,76 @@
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+from spotify.dashapps import vc_shared
+
+def catalog(rows=10):
+    rng = np.random.default_rng(rows)
+    ids = [ f"{n:022d}" for n in range(rows) ]
+    return ids, rng.random((rows, 3))
+
+def refs(root, key):
+    with open(os.path.join(root, key, "refs.json")) as f:
+        return json.load(f)
+
+@pytest.fixture
+def root(tmp_path):
+    yield str(tmp_path)
+    for key in list(vc_shared._open):
+        vc_shared.detach(key)
+
+def test_publish_and_attach(root):
+    ids, features = catalog()
+    key = vc_shared.publish(ids, features, root=root)
+
+    assert vc_shared.publish(ids, features, root=root) == key
+    shared = vc_shared.attach(key, root=root)
+    np.testing.assert_array_equal(shared.features, features)
+    assert shared.index_of(ids[3], ids[7]) == [3, 7]
+    with pytest.raises(KeyError):
+        shared.index_of("0" * 21 + "x")
+    assert refs(root, key)["pids"] == {str(os.getpid()): 1}
+    assert vc_shared.attach("missing", root=root) is None
+
+def test_forked_child_registers_its_own_reference(root):
+    ids, features = catalog()
+    key = vc_shared.publish(ids, features, root=root)
+    vc_shared.attach(key, root=root)
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0: # child, which inherited the parent's open catalog
+        try:
+            vc_shared.attach(key, root=root)
+            os.write(write, b"attached")
+            time.sleep(1) # stay alive while the parent reads the references
+        finally:
+            os._exit(0)
+    try:
+        assert os.read(read, 8) == b"attached"
+        assert refs(root, key)["pids"] == {str(os.getpid()): 1, str(pid): 1}
+    finally:
+        os.waitpid(pid, 0)
+
+    vc_shared.detach(key)
+    vc_shared.evict_cold(root, cold_after=0) # the child has exited, so nothing holds it
+    assert not os.path.isdir(os.path.join(root, key))
+
+def test_sweeper_releases_idle_and_evicts_cold_catalogs(root, monkeypatch):
+    monkeypatch.setattr(vc_shared, "SWEEP_EVERY", 0.05)
+    monkeypatch.setattr(vc_shared, "IDLE_AFTER", 0.1)
+    monkeypatch.setattr(vc_shared, "COLD_AFTER", 0.1)
+    monkeypatch.setattr(vc_shared, "_sweeper", None) # one started by an earlier test sleeps for the old interval
+    ids, features = catalog()
+    key = vc_shared.publish(ids, features, root=root)
+    vc_shared.attach(key, root=root)
+
+    deadline = time.monotonic() + 5
+    while os.path.isdir(os.path.join(root, key)) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert key not in vc_shared._open
+    assert not os.path.isdir(os.path.join(root, key))
@@ -0,0 +1,174 @@
+""" Offline batch routing: pre-generates vibe journeys from a catalog without the website.
+A catalog is a vc_shared directory of .npy files, either one the app has published under CATALOG_DIR or one written
+with vc_loader.export_job. Every worker process memory-maps it read-only, jobs are sent as row numbers in chunks, and
+routes are appended to a JSON lines file as they complete (in completion order, not job order).
+Only numpy is needed at run time.
+
+Examples:
+    python -m spotify.dashapps.vc_batch CATALOG --seeds seeds.txt --steps 5 10 20 --out journeys.jsonl
+    python -m spotify.dashapps.vc_batch CATALOG --jobs jobs.jsonl --out journeys.jsonl --workers 8 --seed 1
+
+--seeds is a file of spotify ids, one per line, and routes every ordered pair at every --steps.
+--jobs is a JSON lines file of {"origin": id, "destination": id, "steps": n}.
+Each output line is {"origin", "destination", "steps", "route": [spotify ids], "stops": [[d, e, v], ...]},
+or {"origin", "destination", "steps", "error"} if a job could not be routed. """
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from . import vc_shared # catalogs shared between processes
+from . import vc_clusters # clustered vibe regions
+
+CHUNK_SIZE = 64 # jobs per task sent to a worker
+IN_FLIGHT = 4 # chunks queued per worker, so jobs are read and results written as the pool goes
+
+# Set in each worker by _open_catalog
+_catalog = None
+
+def _open_catalog(path):
+    """ Worker initializer: maps the catalog once per process """
+    global _catalog
+    _catalog = vc_shared.Catalog(path)
+    np.random.seed() # forked workers inherit the parent's random state
+
+def _route_chunk(jobs, seed=None):
+    """ Runs in a worker. Expects (origin row, destination row, steps) jobs
+    Returns (stops, route rows) or an error message for each job """
+    results = []
+    for origin, destination, steps in jobs:
+        if seed is not None: # same route for the same job however jobs are split between workers
+            np.random.seed(zlib.crc32(f"{seed}:{origin}:{destination}:{steps}".encode()))
+        try:
+            stops, route = vc_clusters.route_catalog(_catalog, origin, destination, steps)
+            results.append((stops.tolist(), route))
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    return results
+
+def catalog_dir(catalog):
+    """ Accepts a catalog directory, or the key of a catalog published under vc_shared.CATALOG_DIR """
+    if os.path.isdir(catalog):
+        return catalog
+    return vc_shared.catalog_path(catalog)
+
+def seed_jobs(seed_ids, steps):
+    """ Returns a job for every ordered pair of seed ids at every step count """
+    return ( (origin, destination, n) for origin, destination in itertools.permutations(seed_ids, 2) for n in steps )
+
+def read_jobs(f):
+    """ Reads (origin, destination, steps) jobs from a JSON lines file """
+    for line in f:
+        if line.strip():
+            job = json.loads(line)
+            yield job["origin"], job["destination"], int(job["steps"])
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def run(catalog_path, jobs, out, workers=None, chunk_size=CHUNK_SIZE, seed=None):
+    """ Routes every (origin id, destination id, steps) job with a process pool, writing one JSON line per job to out
+    Returns the number of routes and errors written """
+    catalog = vc_shared.Catalog(catalog_path)
+    ids = [ spotify_id.decode() for spotify_id in catalog.ids ]
+    workers = workers or os.cpu_count() or 1
+    counts = {"routes": 0, "errors": 0}
+
+    def write(job, result):
+        origin, destination, steps = job
+        line = {"origin": origin, "destination": destination, "steps": steps}
+        if isinstance(result, str):
+            line["error"] = result
+            counts["errors"] += 1
+        else:
+            line["route"] = [ ids[idx] for idx in result[1] ]
+            line["stops"] = result[0]
+            counts["routes"] += 1
+        out.write(json.dumps(line) + "\n")
+
+    def collect(done):
+        for future in done:
+            chunk = pending.pop(future)
+            for job, result in zip(chunk, future.result()):
+                write(job, result)
+        out.flush()
+
+    pending = {} # future: chunk of jobs by spotify id
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_catalog, initargs=(catalog_path,)) as pool:
+        for chunk in chunked(jobs, chunk_size):
+            # Look up rows here, so unknown ids are reported without a trip to a worker
+            rows = []
+            for origin, destination, steps in chunk:
+                try:
+                    if steps < 1:
+                        raise ValueError(f"steps must be at least 1, got {steps}")
+                    rows.append((*catalog.index_of(origin, destination), steps))
+                except (KeyError, ValueError) as e:
+                    write((origin, destination, steps), f"{type(e).__name__}: {e}")
+                    rows.append(None)
+            chunk = [ job for job, row in zip(chunk, rows) if row is not None ]
+            if not chunk:
+                continue
+
+            if len(pending) >= workers * IN_FLIGHT:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[pool.submit(_route_chunk, [ row for row in rows if row is not None ], seed)] = chunk
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    return counts["routes"], counts["errors"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Route many (origin, destination, steps) jobs over a Vibe Compass catalog")
+    parser.add_argument("catalog", help="catalog directory, or the key of a catalog published under VC_CATALOG_DIR")
+    jobs_from = parser.add_mutually_exclusive_group(required=True)
+    jobs_from.add_argument("--seeds", help="file of spotify ids, one per line, to route every ordered pair of")
+    jobs_from.add_argument("--jobs", help="JSON lines file of {\"origin\", \"destination\", \"steps\"} jobs")
+    parser.add_argument("--steps", type=int, nargs="+", default=[5], help="step counts for --seeds")
+    parser.add_argument("--out", default="-", help="JSON lines file to append routes to, - for stdout")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the number of CPUs")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="jobs per task sent to a worker")
+    parser.add_argument("--seed", type=int, default=None, help="make routes reproducible")
+    args = parser.parse_args(argv)
+
+    path = catalog_dir(args.catalog)
+    if not os.path.isfile(os.path.join(path, "meta.json")):
+        parser.error(f"no catalog at {path}")
+
+    if args.seeds:
+        with open(args.seeds) as f:
+            seed_ids = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+        jobs = seed_jobs(seed_ids, args.steps)
+        jobs_file = None
+    else:
+        jobs_file = open(args.jobs)
+        jobs = read_jobs(jobs_file)
+
+    out = sys.stdout if args.out == "-" else open(args.out, "a")
+    start = time.perf_counter()
+    try:
+        routes, errors = run(path, jobs, out, args.workers, args.chunk_size, args.seed)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if jobs_file is not None:
+            jobs_file.close()
+    elapsed = time.perf_counter() - start
+    print(f"{routes} routes, {errors} errors in {elapsed:.1f}s ({routes/elapsed if elapsed else 0:.1f} routes/s)", file=sys.stderr)
+    return 0 if errors == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
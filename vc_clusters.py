@@ -0,0 +1,155 @@
+""" Clustered vibe regions for large playlists.
+Songs are grouped into fine clusters with mini-batch k-means, fitted page by page while a playlist loads, and the fine
+clusters are grouped again into a few coarse regions. Routing first finds which clusters the straight path passes
+through and then only looks at songs inside them, and the Vibe Map can draw one marker per cluster instead of one per
+song, from the clusters fitted so far while the playlist is still loading. Only numpy is needed. """
+
+import numpy as np
+
+from . import vc_linalg # linear algebra for plotting routes
+
+CLUSTER_ROUTE_MIN = 5000 # songs before routing goes through clusters
+OVERVIEW_MIN = 20000 # songs before the Vibe Map shows clusters instead of songs
+ARRAYS = ["centroids", "counts", "radius", "order", "start", "parent", "coarse"] # saved with a shared catalog
+
+def fine_clusters_for(n):
+    """ Returns how many fine clusters to use for n songs, roughly 200 songs per cluster """
+    return int(np.clip(n // 200, 8, 512))
+
+class VibeClusters(object):
+    """ Two level clustering of a playlist's features.
+    Call partial_fit with each batch of songs as they load, then finalize with the full feature matrix """
+
+    def __init__(self, n_clusters=64, n_coarse=8, seed=0):
+        self.n_clusters = n_clusters
+        self.n_coarse = n_coarse
+        self.centroids = None # (clusters, dimensions)
+        self.counts = None # songs each centroid has been updated with
+        self.rng = np.random.default_rng(seed)
+        self._waiting = [] # early batches, held until there are enough songs to seed every centroid
+
+    def partial_fit(self, features):
+        """ One mini-batch k-means update (Sculley 2010): each centroid moves towards the songs nearest to it
+        with a step size that shrinks as it gathers songs. Cost is proportional to the batch, not the playlist """
+        features = np.asarray(features, dtype=np.float64)
+        if len(features) == 0:
+            return self
+        if self.centroids is None:
+            self._waiting.append(features)
+            if sum(len(batch) for batch in self._waiting) < 4 * self.n_clusters:
+                return self
+            features = np.concatenate(self._waiting)
+            self._waiting = []
+            self.init_centroids(features)
+        labels = nearest(features, self.centroids)
+        batch_counts = np.bincount(labels, minlength=len(self.centroids))
+        sums = np.zeros_like(self.centroids)
+        np.add.at(sums, labels, features)
+        hit = batch_counts > 0
+        self.counts[hit] += batch_counts[hit]
+        step = (batch_counts[hit] / self.counts[hit])[:, None]
+        self.centroids[hit] += step * (sums[hit] / batch_counts[hit][:, None] - self.centroids[hit])
+        return self
+
+    def init_centroids(self, features):
+        """ Seeds centroids with k-means++ on the first batch """
+        k = min(self.n_clusters, len(features))
+        centroids = [features[self.rng.integers(len(features))]]
+        closest = np.sum((features - centroids[0]) ** 2, axis=1) # squared distance to the nearest chosen centroid
+        for _ in range(1, k):
+            if closest.sum() == 0:
+                break
+            centroids.append(features[self.rng.choice(len(features), p=closest / closest.sum())])
+            closest = np.minimum(closest, np.sum((features - centroids[-1]) ** 2, axis=1))
+        self.centroids = np.array(centroids)
+        self.counts = np.ones(len(self.centroids))
+
+    def finalize(self, features):
+        """ Assigns every song to its cluster, and builds the coarse level over the cluster centroids
+        Returns a dictionary of arrays (see ARRAYS) to store alongside the catalog """
+        features = np.asarray(features, dtype=np.float64)
+        if self.centroids is None: # never had enough songs for partial_fit to start
+            self._waiting = []
+            self.init_centroids(features if len(features) else np.zeros((1, 3)))
+        labels = nearest(features, self.centroids)
+
+        # Drop clusters nobody ended up in, then index songs by cluster: their order, and where each cluster starts in it
+        used = np.unique(labels)
+        centroids = self.centroids[used]
+        labels = np.searchsorted(used, labels)
+        order = np.argsort(labels, kind="stable")
+        start = np.searchsorted(labels[order], np.arange(len(centroids) + 1))
+        counts = np.diff(start)
+        radius = np.zeros(len(centroids))
+        np.maximum.at(radius, labels, np.linalg.norm(features - centroids[labels], axis=1)) # furthest member
+
+        coarse, parent = coarse_regions(centroids, counts, self.n_coarse)
+        return {"centroids": centroids, "counts": counts, "radius": radius, "order": order, "start": start,
+                "parent": parent, "coarse": coarse}
+
+    def summary(self):
+        """ Returns the centroid, song count and coarse region of each cluster fitted so far, like summary does for
+        finalized clusters, so the Vibe Map can show the overview while the playlist is still loading
+        None until there have been enough songs to seed the centroids """
+        if self.centroids is None:
+            return None
+        used = self.counts > 1 # counts start at one
+        centroids, counts = self.centroids[used].copy(), self.counts[used] - 1
+        return centroids, counts, coarse_regions(centroids, counts, self.n_coarse)[1]
+
+def coarse_regions(centroids, counts, n_coarse):
+    """ Weighted k-means over the fine centroids, which is cheap as there are few of them
+    Returns the coarse centroids, and the coarse region of each fine cluster """
+    coarse = centroids[np.argsort(-counts)[:min(n_coarse, len(centroids))]].copy()
+    for _ in range(10):
+        parent = nearest(centroids, coarse)
+        for c in range(len(coarse)):
+            weights = counts[parent == c]
+            if weights.sum() > 0:
+                coarse[c] = np.average(centroids[parent == c], axis=0, weights=weights)
+    return coarse, nearest(centroids, coarse)
+
+def nearest(points, centroids):
+    """ Returns the index of the nearest centroid for each point """
+    labels = np.empty(len(points), dtype=np.int64)
+    centroid_sq = np.sum(centroids ** 2, axis=1)
+    for n in range(0, len(points), 16384): # chunked to bound the points x centroids distance matrix
+        chunk = points[n:n+16384]
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2, and |x|^2 is the same for every centroid
+        labels[n:n+16384] = np.argmin(centroid_sq[None, :] - 2 * chunk @ centroids.T, axis=1)
+    return labels
+
+def path_clusters(clusters, stops, radius=0.15):
+    """ Expects finalized cluster arrays and the direct path stops
+    Returns the clusters any stop's radius could reach: those whose furthest member could be within radius of the path """
+    centroids = clusters["centroids"] # few enough to check them all
+    start, line = stops[0], stops[-1] - stops[0]
+    length_sq = np.dot(line, line)
+    t = np.clip((centroids - start) @ line / length_sq, 0, 1) if length_sq else np.zeros(len(centroids))
+    distances = np.linalg.norm(centroids - (start + t[:, None]*line), axis=1)
+    return np.flatnonzero(distances <= radius + clusters["radius"])
+
+def route_clustered(features, clusters, origin, destination, steps):
+    """ Same as vc_linalg.route_features, but only considers songs in the clusters the path passes through
+    Any song within radius of a stop is in a touched cluster, so the route's choices are the same """
+    features = vc_linalg.feature_matrix(features)
+    stops = vc_linalg.get_direct_path(features, origin, destination, steps)
+    touched = path_clusters(clusters, stops)
+
+    # Origin and destination are on the path, so their clusters are always touched
+    subset = np.concatenate([ clusters["order"][clusters["start"][c]:clusters["start"][c+1]] for c in touched ])
+    sub_origin = int(np.flatnonzero(subset == origin)[0])
+    sub_destination = int(np.flatnonzero(subset == destination)[0])
+    stops, route = vc_linalg.route_features(np.asarray(features[subset]), sub_origin, sub_destination, steps)
+    return stops, [ int(subset[idx]) for idx in route ]
+
+def route_catalog(catalog, origin, destination, steps):
+    """ Expects a vc_shared catalog and row numbers of origin and destination
+    Routes through the catalog's clusters when it is big enough for that to be quicker """
+    if catalog.clusters is not None and len(catalog) >= CLUSTER_ROUTE_MIN:
+        return route_clustered(catalog.features, catalog.clusters, origin, destination, steps)
+    return vc_linalg.route_features(catalog.features, origin, destination, steps)
+
+def summary(clusters):
+    """ Returns each fine cluster's centroid, song count and coarse region, for the Vibe Map overview """
+    return clusters["centroids"], clusters["counts"], clusters["parent"]
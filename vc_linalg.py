@@ -1,15 +1,20 @@
 import numpy as np
-import pandas as pd
-import plotly.graph_objs as go
+
+def feature_matrix(df):
+    """ Expects a playlist dataframe, or a feature matrix which is returned unchanged
+    Returns the danceability, energy and valence columns as a numpy array """
+    if isinstance(df, np.ndarray):
+        return df
+    return df.loc[:,"danceability":"valence"].to_numpy(dtype=np.float64)
 
 def distance_to_all(df, coord1):
     """ Expects coordinates in multi dimensional space
     Returns euclidean distance between coord1 and songs in df """
-    all_songs = df.loc[:,"danceability":"valence"].to_numpy(dtype=np.float64)
+    all_songs = feature_matrix(df)
     #return np.sqrt(np.sum(np.square(this_song - all_songs), axis=1))
     return np.linalg.norm(coord1 - all_songs, axis=1) # euclidean distance
 
-# TODO: Radius should be based on density so we don't go back on ourselves, or even directional.
+# TODO: Radius should be based on density so sparse parts of a playlist still have choices.
 
 def song_radius(df, coord1, radius=0.15):
     """ Expects index for a song and radius
@@ -19,6 +24,60 @@ def song_radius(df, coord1, radius=0.15):
     # nearby_songs = np.delete(nearby_songs, np.where(nearby_songs == idx1)) # remove this song from list of nearby songs
     return nearby_songs
 
+def near_path(df, stops, radius=0.15):
+    """ Expects the direct path stops
+    Returns indexes of songs within radius of the straight line, the only songs any stop can pick from """
+    features = feature_matrix(df)
+    start, line = stops[0], stops[-1] - stops[0]
+    length_sq = np.dot(line, line)
+    if length_sq == 0: # origin and destination are in the same place
+        return song_radius(features, start, radius)
+    t = np.clip((features - start) @ line / length_sq, 0, 1) # how far along the line each song's closest point is
+    distances = np.linalg.norm(features - (start + t[:, None]*line), axis=1)
+    return np.where(distances <= radius)[0]
+
+def song_cones(df, stops, radius=0.15, angle=60):
+    """ Expects the direct path stops, radius and the cone's half angle in degrees
+    Returns a list of song indexes for each stop after the origin: songs within radius of the stop which are
+    also within angle of the origin > destination bearing, as seen from the previous stop.
+    These only depend on the path, route_features also drops those behind the last song it picked (see ahead_of).
+    Only songs near the path are considered, and each stop only looks at those whose position along the
+    path is within radius of its own, so memory grows with one stop's neighbourhood rather than the whole path """
+    features = feature_matrix(df)
+    candidates = near_path(features, stops, radius)
+    bearing = stops[-1] - stops[0]
+    if len(candidates) == 0 or not np.any(bearing):
+        return [candidates for _ in stops[1:]]
+    bearing = bearing / np.linalg.norm(bearing)
+    songs = features[candidates]
+
+    # A song within radius of a stop is within radius of it along the path too, so sort by position along the path
+    along_path = (songs - stops[0]) @ bearing
+    order = np.argsort(along_path)
+    along_path = along_path[order]
+    stops_along = (stops - stops[0]) @ bearing
+
+    cones = []
+    for n in range(1, len(stops)):
+        lo = np.searchsorted(along_path, stops_along[n] - radius, side="left")
+        hi = np.searchsorted(along_path, stops_along[n] + radius, side="right")
+        nearby = np.sort(order[lo:hi]) # positions in candidates, kept in index order
+        to_stop = songs[nearby] - stops[n]
+        from_apex = songs[nearby] - stops[n-1] # offset from the stop before, the cone's apex
+        within_radius = np.einsum("nd,nd->n", to_stop, to_stop) <= radius**2
+        in_cone = from_apex @ bearing >= np.cos(np.radians(angle)) * np.linalg.norm(from_apex, axis=1)
+        cones.append(candidates[nearby[within_radius & in_cone]])
+    return cones
+
+def ahead_of(df, songs, position, bearing):
+    """ Expects song indexes, the coordinates the route has got to and the origin > destination bearing
+    Returns the songs further along the bearing than position, so a route does not double back """
+    features = feature_matrix(df)
+    songs = np.asarray(songs, dtype=np.int64)
+    if not np.any(bearing):
+        return songs
+    return songs[(features[songs] - position) @ bearing > 0]
+
 def uri_to_idx(df, *args):
     """ Expects spotify uris and a dataframe
     Returns dataframe index for those spotify URIs """
@@ -32,8 +91,9 @@ def get_direct_path(df, origin, destination, steps):
     Returns an array of all the points inbetween """
 
     # Get coordinates of origin and destination, and step vector
-    origin_coords = df.loc[origin, "danceability":"valence"].to_numpy(dtype=np.float64)
-    destination_coords = df.loc[destination, "danceability":"valence"].to_numpy(dtype=np.float64)
+    features = feature_matrix(df)
+    origin_coords = features[origin]
+    destination_coords = features[destination]
     step = (destination_coords - origin_coords)/steps # step = full route / steps
 
     path_coords = np.zeros((steps+1, origin_coords.shape[0])) # Set up empty array
@@ -48,15 +108,27 @@ def plot_bearing(df, origin_uri, destination_uri, steps):
     
     # Convert URI to indexes
     origin, destination = uri_to_idx(df, origin_uri, destination_uri)
-    
+    return route_features(feature_matrix(df), origin, destination, steps)
+
+def route_features(features, origin, destination, steps):
+    """ Expects a feature matrix, row numbers of origin and destination, and number of steps
+    Same as plot_bearing but only needs the numpy array, so it is cheap to send to another process """
+
     # Get straight line path
-    stops = get_direct_path(df, origin, destination, steps)
+    stops = get_direct_path(features, origin, destination, steps)
     
+    # Songs ahead of each stop, towards the destination
+    cones = song_cones(features, stops)
+    bearing = stops[-1] - stops[0]
+
     # Find a route
     playlist = [origin] # playlist will be a list of indexes, which we can use with the main df, ie. df[playlist]
     #playlist_combinations = [[origin]]  # not currently used
-    for stop in stops[1:-1]: # first and last stops are origin/destination
-        song_choices = song_radius(df, stop) # get options for next song
+    for stop, song_choices in zip(stops[1:-1], cones): # first and last stops are origin/destination
+        # Only songs past the one we're on, the cone alone lets a route step back towards its previous stop
+        song_choices = ahead_of(features, song_choices, features[playlist[-1]], bearing)
+        if len(song_choices) == 0: # nothing ahead, fall back to anything nearby that is still ahead
+            song_choices = ahead_of(features, song_radius(features, stop), features[playlist[-1]], bearing) # get options for next song
         # playlist_combinations.append(song_choices)
         
         # remove duplicates and add next song
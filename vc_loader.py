@@ -0,0 +1,220 @@
+""" Progressive playlist loading for the Vibe Map.
+A load runs as a coroutine on spotifyAPI's background event loop: it fetches every page of the playlist and the
+audio features for each page concurrently, and appends rows to the job's catalog in playlist order, holding back a
+page that arrives early until the pages before it are in. Each page of rows is written to Django's cache once, under
+its own key, next to a small progress entry. The Dash app polls the progress with load_progress and reads only the
+pages it hasn't seen with load_rows, so the first songs show up after the first page rather than after the whole
+playlist, and neither the loader nor a poll handles the whole playlist again. The song dropdowns search a separate
+index of just the song labels and ids, see load_labels. Use a shared cache backend (eg. redis)
+when running more than one worker process.
+Songs are clustered page by page as they are appended, and once a playlist is big enough for the Vibe Map to draw
+clusters the progress entry carries their summary, so the overview is there while the rest loads. Once the playlist
+has loaded, its features and clusters are published with vc_shared for every worker to map. Rows are in the same
+order however the pages arrived, so every load of a playlist publishes the same catalog key and shares one copy.
+export_job writes a loaded playlist out the same way for vc_batch. """
+
+import asyncio
+import logging
+import uuid
+
+import httpx
+import numpy as np
+from django.core.cache import cache
+
+from .. import spotifyAPI
+from . import vc_shared # catalogs shared between processes
+from . import vc_clusters # clustered vibe regions
+
+LOAD_TTL = 3600 # seconds a load stays in the cache after it was last used, the app reads songs from it
+REFRESH_EVERY = 300 # seconds between extending a load's TTL, so it lasts at least LOAD_TTL - REFRESH_EVERY after use
+PAGE_SIZE = 100 # playlist tracks per request, Spotify's maximum
+CONCURRENT_PAGES = 8 # pages in flight at once per load
+COLUMNS = ["artist", "track_title", "album_art_url", "spotify_id", "danceability", "energy", "valence"]
+
+logger = logging.getLogger(__name__)
+
+def job_key(job_id):
+    return f"vc-load:{job_id}"
+
+def page_key(job_id, page):
+    return f"vc-load:{job_id}:{page}"
+
+def labels_key(job_id):
+    return f"vc-load:{job_id}:labels"
+
+def refreshed_key(job_id):
+    return f"vc-load:{job_id}:refreshed"
+
+def song_label(artist, title):
+    return f"{artist} - {title}"
+
+def empty_data():
+    """ Returns an empty catalog: a dictionary of COLUMNS lists """
+    return {column: [] for column in COLUMNS}
+
+def track_rows(items, audio_features):
+    """ Expects playlist track items and their audio features (same order)
+    Returns a catalog dictionary, skipping local files and tracks without features """
+    data = empty_data()
+    features_by_id = {f["id"]: f for f in audio_features if f is not None}
+    for item in items:
+        track = item.get("track")
+        if track is None or track.get("id") not in features_by_id:
+            continue
+        features = features_by_id[track["id"]]
+        images = track["album"]["images"]
+        data["artist"].append(track["artists"][0]["name"])
+        data["track_title"].append(track["name"])
+        data["album_art_url"].append(images[min(2, len(images)-1)]["url"] if images else None) # 0 for 640, 1 for 300, 2 for 64
+        data["spotify_id"].append(track["id"])
+        data["danceability"].append(features["danceability"])
+        data["energy"].append(features["energy"])
+        data["valence"].append(features["valence"])
+    return data
+
+def start_load(client_creds, refresh_token, playlist_uri):
+    """ Starts loading a playlist in the background and returns a job id for load_progress """
+    job_id = uuid.uuid4().hex
+    cache.set(job_key(job_id), {"status": "loading", "loaded": 0, "total": None, "pages": 0, "overview": None, "catalog": None},
+            LOAD_TTL)
+    asyncio.run_coroutine_threadsafe(load(job_id, client_creds, refresh_token, playlist_uri), spotifyAPI.bridge_loop())
+    return job_id
+
+def load_progress(job_id):
+    """ Returns the job's state: status ("loading", "done", "revoked" or "error"), tracks loaded so far,
+    total tracks in the playlist, pages of rows written so far, the cluster overview (centroids, counts and regions, see
+    vc_clusters.summary) once there are OVERVIEW_MIN songs, and the vc_shared key once it has been published.
+    None if the job has expired. Reading a job keeps it, its pages and its labels in the cache for another LOAD_TTL,
+    refreshed at most every REFRESH_EVERY seconds so polls and searches don't touch every page """
+    progress = cache.get(job_key(job_id))
+    if progress is not None and cache.add(refreshed_key(job_id), True, REFRESH_EVERY):
+        keys = [job_key(job_id), labels_key(job_id)] + [ page_key(job_id, page) for page in range(progress["pages"]) ]
+        for key in keys:
+            cache.touch(key, LOAD_TTL)
+    return progress
+
+def load_rows(job_id, start, stop):
+    """ Returns a catalog dictionary of the job's pages from start up to stop, in playlist order
+    None if any of them have expired. Use load_progress first, which keeps the pages in the cache """
+    keys = [ page_key(job_id, page) for page in range(start, stop) ]
+    pages = cache.get_many(keys)
+    if len(pages) < len(keys):
+        return None
+    data = empty_data()
+    for key in keys:
+        for column in COLUMNS:
+            data[column].extend(pages[key][column])
+    return data
+
+def load_labels(job_id):
+    """ Returns the job's song labels ("artist - title") and spotify ids so far, {"labels": [...], "ids": [...]} in
+    playlist order. None if the job has expired. Use load_progress first, which keeps them in the cache """
+    return cache.get(labels_key(job_id))
+
+def export_catalog(data, path):
+    """ Expects a playlist data dictionary (see COLUMNS) and a directory
+    Writes it as a vc_shared catalog, with clusters, for offline tools like vc_batch to memory-map """
+    features = np.array([data["danceability"], data["energy"], data["valence"]], dtype=np.float64).T
+    clusters = vc_clusters.VibeClusters(vc_clusters.fine_clusters_for(len(features)))
+    vc_shared.write_catalog(path, features, data["spotify_id"], clusters=clusters.partial_fit(features).finalize(features))
+    return path
+
+def export_job(job_id, path):
+    """ Exports a load job's playlist with export_catalog. Raises KeyError if the job has expired """
+    progress = load_progress(job_id)
+    data = load_rows(job_id, 0, progress["pages"]) if progress is not None else None
+    if data is None:
+        raise KeyError(f"load job {job_id} has expired")
+    return export_catalog(data, path)
+
+async def load(job_id, client_creds, refresh_token, playlist_uri):
+    """ Loads every page of a playlist, publishing each page of rows to the cache as it is appended """
+    state = {"status": "loading", "loaded": 0, "total": None, "pages": 0, "overview": None, "catalog": None}
+    data = empty_data() # the whole catalog, only kept here to publish it with vc_shared at the end
+    labels = {"labels": [], "ids": []} # what the song dropdowns search, republished whole as it is small
+    unpublished = [] # rows appended since the last publish
+    sp = None
+    pages = []
+    held = {} # offset: (page, rows) for pages that arrived before the ones ahead of them
+
+    async def publish():
+        # New pages go in first, so a poll never sees a page count it can't read
+        entries = { page_key(job_id, state["pages"] + n): rows for n, rows in enumerate(unpublished) }
+        if entries:
+            entries[labels_key(job_id)] = labels
+            await asyncio.to_thread(cache.set_many, entries, LOAD_TTL)
+        state["pages"] += len(unpublished)
+        unpublished.clear()
+        if state["status"] == "loading" and len(data["spotify_id"]) >= vc_clusters.OVERVIEW_MIN:
+            state["overview"] = clusters.summary()
+        await asyncio.to_thread(cache.set, job_key(job_id), state, LOAD_TTL)
+
+    async def load_page(offset, page_size, page=None):
+        async with limit:
+            if page is None:
+                page = await sp.get_playlist(playlist_uri, offset=offset, limit=page_size)
+            ids = [ item["track"]["id"] for item in page["items"] if item.get("track") and item["track"].get("id") ]
+            features = (await sp.get_parameters(ids))["audio_features"] if ids else []
+            return page, track_rows(page["items"], features)
+
+    def append(page, rows):
+        """ Adds a page's rows to the end of the catalog, so only call it in playlist order """
+        for column in COLUMNS:
+            data[column].extend(rows[column])
+        labels["labels"].extend(song_label(artist, title) for artist, title in zip(rows["artist"], rows["track_title"]))
+        labels["ids"].extend(rows["spotify_id"])
+        unpublished.append(rows)
+        state["loaded"] += len(page["items"])
+        clusters.partial_fit(np.array([rows["danceability"], rows["energy"], rows["valence"]], dtype=np.float64).T)
+
+    try:
+        limit = asyncio.Semaphore(CONCURRENT_PAGES)
+        sp = await spotifyAPI.AsyncClient.create(client_creds, refresh_token, refresh=True)
+
+        # The first page gives the total and how many tracks the API will send per page, which may be fewer than we
+        # asked for, so publish it then fetch everything else at once
+        first_page = await sp.get_playlist(playlist_uri, offset=0, limit=PAGE_SIZE)
+        state["total"] = first_page["total"]
+        page_size = first_page["limit"]
+        clusters = vc_clusters.VibeClusters(vc_clusters.fine_clusters_for(first_page["total"]))
+        append(*await load_page(0, page_size, first_page))
+        await publish()
+
+        async def load_slot(offset):
+            return offset, await load_page(offset, page_size)
+
+        # Pages finish in any order, but rows are appended in playlist order, so the catalog (and its key) is the same
+        # for every load of a playlist. Rows are only ever appended, so route indexes stay valid
+        pages = [ asyncio.ensure_future(load_slot(offset)) for offset in range(page_size, first_page["total"], page_size) ]
+        next_offset = page_size
+        for next_page in asyncio.as_completed(pages):
+            offset, page_rows = await next_page
+            held[offset] = page_rows
+            if offset != next_offset:
+                continue
+            while next_offset in held:
+                append(*held.pop(next_offset))
+                next_offset += page_size
+            await publish()
+
+        features = np.array([data["danceability"], data["energy"], data["valence"]], dtype=np.float64).T
+        cluster_arrays = await asyncio.to_thread(clusters.finalize, features)
+        state["catalog"] = await asyncio.to_thread(vc_shared.publish, data["spotify_id"], features, clusters=cluster_arrays)
+        if len(features) >= vc_clusters.OVERVIEW_MIN:
+            state["overview"] = vc_clusters.summary(cluster_arrays)
+        state["status"] = "done"
+    except spotifyAPI.AccessRevoked:
+        state["status"] = "revoked"
+    except (spotifyAPI.InvalidRequest, httpx.HTTPError): # the app shows whatever loaded
+        state["status"] = "error"
+    except Exception:
+        logger.exception("Loading playlist %s failed", playlist_uri)
+        state["status"] = "error"
+    finally:
+        for page in pages: # stop fetching if we gave up part way through
+            page.cancel()
+        for offset in sorted(held): # show everything that did load, the catalog isn't published after a failure
+            append(*held.pop(offset))
+        if sp is not None:
+            await sp.aclose()
+        await publish()
@@ -0,0 +1,251 @@
+""" Playlist catalogs shared between worker processes.
+A catalog is published once as .npy files (feature matrix, spotify ids, id index and clusters) under CATALOG_DIR,
+which defaults to /dev/shm so the files live in memory. Every worker process memory-maps the same files read-only,
+so a playlist's features are held once however many gunicorn workers handle its callbacks.
+Processes register a reference while they have a catalog open, and catalogs with no live references that haven't
+been used for COLD_AFTER seconds are deleted. Each process checks every SWEEP_EVERY seconds from a daemon thread. Only numpy is needed, so offline tools can read catalogs too. """
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+CATALOG_DIR = os.environ.get("VC_CATALOG_DIR",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "vibe-compass"))
+COLD_AFTER = 900 # seconds without use before an unreferenced catalog is deleted
+IDLE_AFTER = 300 # seconds a process keeps an unused catalog open
+TOUCH_EVERY = 10 # seconds between last used updates, to keep lock traffic down
+SWEEP_EVERY = 60 # seconds between checks for idle and cold catalogs
+FILES = ["features", "ids", "id_order"]
+
+logger = logging.getLogger(__name__)
+
+def catalog_key(ids, features):
+    """ Returns a key for a catalog's contents, so sessions with the same playlist share one copy """
+    digest = hashlib.sha1()
+    digest.update("\n".join(ids).encode())
+    digest.update(np.ascontiguousarray(features, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:24]
+
+def catalog_path(key, root=None):
+    return os.path.join(root or CATALOG_DIR, key)
+
+def write_catalog(path, features, ids, clusters=None):
+    """ Writes a catalog directory: the .npy files and meta.json
+    clusters is an optional dictionary of arrays from vc_clusters.VibeClusters.finalize """
+    features = np.ascontiguousarray(features, dtype=np.float64)
+    ids = np.array(ids, dtype="S22") # spotify ids are 22 characters
+    arrays = {"features": features, "ids": ids, "id_order": np.argsort(ids)}
+    os.makedirs(path, exist_ok=True)
+    for name in FILES:
+        np.save(os.path.join(path, f"{name}.npy"), arrays[name])
+    for name, array in (clusters or {}).items():
+        np.save(os.path.join(path, f"cluster_{name}.npy"), array)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"rows": len(ids), "columns": ["danceability", "energy", "valence"], "clusters": sorted(clusters or {})}, f)
+
+def publish(ids, features, root=None, clusters=None):
+    """ Expects spotify ids and their feature matrix, and optionally their clusters
+    Publishes them as a shared catalog unless one with the same contents exists, and returns its key """
+    root = root or CATALOG_DIR
+    key = catalog_key(ids, features)
+    path = catalog_path(key, root)
+    if os.path.isdir(path):
+        return key
+
+    # Write somewhere private then rename, so other processes never see a half written catalog
+    os.makedirs(root, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=f".{key}-", dir=root)
+    try:
+        write_catalog(staging, features, ids, clusters=clusters)
+        os.rename(staging, path)
+    except OSError:
+        if not os.path.isdir(path): # lost a race with another process publishing the same catalog, which is fine
+            raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    with _refs(path) as refs:
+        refs["last_used"] = time.time()
+    evict_cold(root)
+    start_sweeper(root)
+    return key
+
+class Catalog(object):
+    """ A read-only, memory-mapped catalog """
+
+    def __init__(self, path):
+        self.path = path
+        self.key = os.path.basename(path)
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        for name in FILES:
+            setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r"))
+        # vc_clusters arrays, or None if the catalog was published without them
+        self.clusters = { name: np.load(os.path.join(path, f"cluster_{name}.npy"), mmap_mode="r")
+                        for name in self.meta.get("clusters", []) } or None
+        self.last_used = time.monotonic()
+        self._touched = 0
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def index_of(self, *spotify_ids):
+        """ Returns row numbers for spotify ids, like vc_linalg.uri_to_idx. Raises KeyError if one is missing """
+        if len(self) == 0:
+            raise KeyError(f"catalog {self.key} is empty")
+        wanted = np.array(spotify_ids, dtype="S22")
+        positions = np.searchsorted(self.ids, wanted, sorter=self.id_order)
+        idxs = self.id_order[np.minimum(positions, len(self)-1)]
+        if np.any(self.ids[idxs] != wanted):
+            raise KeyError(f"spotify id not in catalog {self.key}")
+        return [ int(idx) for idx in idxs ]
+
+    def touch(self):
+        """ Marks the catalog as used, so it isn't evicted while it's warm """
+        self.last_used = time.monotonic()
+        if self.last_used - self._touched > TOUCH_EVERY:
+            self._touched = self.last_used
+            with _refs(self.path) as refs:
+                refs["last_used"] = time.time()
+
+# Catalogs this process has open
+_open = {} # key: Catalog
+_open_lock = threading.Lock()
+_sweeper = None # thread running _sweep
+_roots = set() # catalog directories this process has used
+
+def _forget_open():
+    """ Runs in a forked child, which inherits the parent's open catalogs but not its references to them
+    Starting empty makes the child's first attach register its own pid, so eviction knows it's still mapped """
+    global _open_lock, _sweeper
+    _open.clear()
+    _open_lock = threading.Lock() # another thread of the parent may have held it when we forked
+    _sweeper = None # threads don't survive a fork, the child's first attach starts its own
+
+os.register_at_fork(after_in_child=_forget_open)
+
+def attach(key, root=None):
+    """ Returns the memory-mapped catalog for key, or None if it isn't published (or has been evicted)
+    The first attach in a process registers a reference to it, released by release_idle or detach """
+    if not key:
+        return None
+    with _open_lock:
+        catalog = _open.get(key)
+        if catalog is None:
+            path = catalog_path(key, root)
+            try:
+                catalog = Catalog(path)
+            except (OSError, ValueError):
+                return None
+            with _refs(path) as refs:
+                pid = str(os.getpid())
+                refs["pids"][pid] = refs["pids"].get(pid, 0) + 1
+            _open[key] = catalog
+    catalog.touch()
+    release_idle()
+    start_sweeper(root)
+    return catalog
+
+def detach(key):
+    """ Closes this process' copy of a catalog and releases its reference """
+    with _open_lock:
+        catalog = _open.pop(key, None)
+    if catalog is None:
+        return
+    with _refs(catalog.path) as refs:
+        pid = str(os.getpid())
+        refs["pids"][pid] = refs["pids"].get(pid, 1) - 1
+        if refs["pids"][pid] <= 0:
+            del refs["pids"][pid]
+
+def release_idle(max_idle=IDLE_AFTER):
+    """ Detaches catalogs this process hasn't used recently """
+    now = time.monotonic()
+    with _open_lock:
+        idle = [ key for key, catalog in _open.items() if now - catalog.last_used > max_idle ]
+    for key in idle:
+        detach(key)
+
+def evict_cold(root=None, cold_after=COLD_AFTER):
+    """ Deletes catalogs with no live references that haven't been used for cold_after seconds
+    Processes that still have one mapped keep working, the memory is freed once they let go """
+    root = root or CATALOG_DIR
+    try:
+        keys = [ key for key in os.listdir(root) if not key.startswith(".") and os.path.isdir(catalog_path(key, root)) ]
+    except FileNotFoundError:
+        return
+    for key in keys:
+        path = catalog_path(key, root)
+        with _refs(path) as refs:
+            refs["pids"] = { pid: count for pid, count in refs["pids"].items() if _alive(int(pid)) }
+            if refs["pids"] or time.time() - refs.get("last_used", 0) < cold_after:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+
+def start_sweeper(root=None):
+    """ Starts this process' sweeper thread if it isn't running, and adds root to the directories it sweeps
+    attach and publish only clean up while there's traffic, so without it a quiet process would keep its references
+    and nothing would be evicted """
+    global _sweeper
+    with _open_lock:
+        _roots.add(root or CATALOG_DIR)
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep, name="vc-catalog-sweeper", daemon=True)
+            _sweeper.start()
+
+def _sweep():
+    """ Releases idle catalogs and deletes cold ones every SWEEP_EVERY seconds """
+    while True:
+        time.sleep(SWEEP_EVERY)
+        with _open_lock:
+            roots = list(_roots)
+        try:
+            release_idle(IDLE_AFTER)
+            for root in roots:
+                evict_cold(root, COLD_AFTER)
+        except Exception:
+            logger.exception("catalog sweep failed")
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+@contextmanager
+def _refs(path):
+    """ Locks and yields a catalog's reference counts {"pids": {pid: count}, "last_used": time}, saving changes """
+    lock_path = f"{path}.lock"
+    with open(lock_path, "a+") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            refs_path = os.path.join(path, "refs.json")
+            try:
+                with open(refs_path) as f:
+                    refs = json.load(f)
+            except (OSError, ValueError):
+                refs = {}
+            refs.setdefault("pids", {})
+            yield refs
+            if os.path.isdir(path):
+                with open(f"{refs_path}.tmp", "w") as f:
+                    json.dump(refs, f)
+                os.replace(f"{refs_path}.tmp", refs_path)
+            else: # catalog evicted
+                try:
+                    os.remove(lock_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
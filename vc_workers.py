@@ -0,0 +1,155 @@
+""" Bounded worker pools for the CPU heavy parts of the Dash callbacks.
+Routes are computed in a process pool and figures are built in a thread pool, so neither runs on the
+request threads serving the cheap callbacks. Each pool admits a limited number of jobs and gives up
+on a job after a timeout, so a burst of slow routes cannot queue up behind each other forever. """
+
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from . import vc_linalg # linear algebra for plotting routes
+from . import vc_shared # catalogs shared between processes
+from . import vc_clusters # clustered vibe regions
+
+# Pool sizes can be tuned per deployment without code changes
+ROUTE_WORKERS = int(os.environ.get("VC_ROUTE_WORKERS", 2)) # processes per web worker
+ROUTE_MAX_PENDING = int(os.environ.get("VC_ROUTE_MAX_PENDING", 8)) # running + waiting route jobs
+ROUTE_TIMEOUT = float(os.environ.get("VC_ROUTE_TIMEOUT", 10)) # seconds
+FIGURE_WORKERS = int(os.environ.get("VC_FIGURE_WORKERS", 4))
+FIGURE_MAX_PENDING = int(os.environ.get("VC_FIGURE_MAX_PENDING", 16))
+FIGURE_TIMEOUT = float(os.environ.get("VC_FIGURE_TIMEOUT", 10))
+
+class PoolBusy(Exception):
+    """ Raised when a pool already has as many jobs as it will admit """
+    pass
+
+class PoolTimeout(Exception):
+    """ Raised when a job does not finish within the pool's timeout """
+    pass
+
+def _reseed():
+    """ Workers forked from the forkserver share its random state, so reseed or they all pick the same songs """
+    np.random.seed()
+
+class BoundedPool(object):
+    """ Wraps an executor with admission control and timeouts.
+    A job holds its slot until it actually finishes, even if the caller has already timed out and moved on """
+
+    def __init__(self, name, make_executor, max_pending, timeout, admission_wait=0.0):
+        self.name = name
+        self.make_executor = make_executor # called lazily, and again if a process pool breaks
+        self.timeout = timeout
+        self.admission_wait = admission_wait # seconds to wait for a free slot before raising PoolBusy
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = self.make_executor()
+            return self._executor
+
+    def submit(self, fn, *args, **kwargs):
+        """ Returns a Future for fn(*args, **kwargs), or raises PoolBusy if no slot frees up in time """
+        if self.admission_wait:
+            admitted = self._slots.acquire(timeout=self.admission_wait)
+        else:
+            admitted = self._slots.acquire(blocking=False)
+        if not admitted:
+            raise PoolBusy(f"{self.name} pool is full")
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self.reset()
+            try:
+                future = self.executor.submit(fn, *args, **kwargs)
+            except BaseException:
+                self._slots.release()
+                raise
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """ Runs fn(*args, **kwargs) in the pool and blocks until it returns
+        Raises PoolBusy, PoolTimeout, or whatever fn raised """
+        future = self.submit(fn, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel() # only stops jobs that haven't started, running ones finish in the background
+            raise PoolTimeout(f"{self.name} job took longer than {self.timeout}s")
+        except BrokenProcessPool:
+            self.reset()
+            raise
+
+    def reset(self):
+        """ Replaces a broken executor with a fresh one """
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+route_pool = BoundedPool(
+    "route",
+    # Forking the web process could copy a lock held by one of its threads (the asyncio bridge, loader timers,
+    # figure pool), so workers start from a clean forkserver. Nothing they import needs Django
+    lambda: ProcessPoolExecutor(max_workers=ROUTE_WORKERS, initializer=_reseed,
+                                mp_context=multiprocessing.get_context("forkserver")),
+    max_pending=ROUTE_MAX_PENDING,
+    timeout=ROUTE_TIMEOUT,
+)
+figure_pool = BoundedPool(
+    "figure",
+    lambda: ThreadPoolExecutor(max_workers=FIGURE_WORKERS, thread_name_prefix="vc-figure"),
+    max_pending=FIGURE_MAX_PENDING,
+    timeout=FIGURE_TIMEOUT,
+    admission_wait=1.0, # figures are cheap, so it's worth waiting briefly rather than leaving the graph stale
+)
+
+@atexit.register
+def _shutdown_pools():
+    route_pool.shutdown()
+    figure_pool.shutdown()
+
+def route(data, origin_uri, destination_uri, steps):
+    """ Expects the playlist data dictionary from vc_loader, spotify ids of origin and destination, and steps
+    Only the feature matrix is sent to the route process, not the whole playlist
+    Returns stops as a numpy array and the route as a list of indexes, like vc_linalg.plot_bearing """
+    features = np.array([data["danceability"], data["energy"], data["valence"]], dtype=np.float64).T
+    origin = data["spotify_id"].index(origin_uri)
+    destination = data["spotify_id"].index(destination_uri)
+    return route_pool.run(vc_linalg.route_features, features, origin, destination, steps)
+
+def figure(build, *args, **kwargs):
+    """ Builds a figure with build(*args, **kwargs) on the figure pool """
+    return figure_pool.run(build, *args, **kwargs)
+
+def route_catalog(catalog, origin_uri, destination_uri, steps):
+    """ Same as route, for a playlist published with vc_shared. Only the catalog key is sent to the route
+    process, which maps the shared feature matrix itself. Raises KeyError if the catalog is unavailable """
+    origin, destination = catalog.index_of(origin_uri, destination_uri)
+    return route_pool.run(_route_catalog, catalog.key, origin, destination, steps)
+
+def _route_catalog(key, origin, destination, steps):
+    """ Runs in the route process """
+    catalog = vc_shared.attach(key)
+    if catalog is None:
+        raise KeyError(f"catalog {key} has been evicted")
+    return vc_clusters.route_catalog(catalog, origin, destination, steps)
@@ -8,7 +8,9 @@ import plotly.graph_objs as go
 from django_plotly_dash import DjangoDash
 from dash.exceptions import PreventUpdate
 
-from . import vc_linalg # linear algebra for plotting routes
+from . import vc_workers # worker pools for routes and figures
+from . import vc_loader # progressive playlist loading
+from . import vc_shared # catalogs shared between worker processes
 
 import json
 import numpy as np
@@ -41,12 +43,13 @@ def serve_layout():
                 html.Div([
                     dcc.Dropdown(id="playlist-selector"),
                     html.Button("Refresh", id="refresh-playlists", n_clicks=0, className="floatright btn btn-primary"),
+                    html.Div(id="load-progress"), # songs loaded so far
                 ], className="options1"),
                 html.Div([                   
                     html.H2("Origin"),
-                    dcc.Dropdown(id="origin-song"),
+                    dcc.Dropdown(id="origin-song", placeholder="Search songs..."),
                     html.H2("Destination"),
-                    dcc.Dropdown(id="destination-song"),
+                    dcc.Dropdown(id="destination-song", placeholder="Search songs..."),
                     html.H2("Steps"),
                     dcc.Input(id="steps", type="number", value=5, min=1, max=50),
                     html.Button("Plot Route", id="plot-route", n_clicks=0, className="floatright btn btn-primary"),
@@ -58,13 +61,15 @@ def serve_layout():
                 html.H2("Your Route"),
                 html.Div(id="playlist-display"), # display the route
                 html.Button("Add to Queue", id="queue-playlist", disabled=True, n_clicks=0, className="floatright btn btn-primary"),
+                html.Button("Save as Playlist", id="save-playlist", disabled=True, n_clicks=0, className="floatright btn btn-primary"),
             ], className="panel")
 
         ], className="app-container"),
                 
-        dcc.Store(id='dataframe-json'), # main dataframe of playlist. default storage_type="memory"
-        dcc.Store(id="route-json"), # serialised route playlist
-        dcc.Store(id="playlist-songs"), # dict of name: song, value: id, for dropdown lists
+        dcc.Store(id="load-job"), # id of the background job loading the playlist, and pages already plotted
+        dcc.Interval(id="load-poll", interval=300, disabled=True), # polls the load job while it runs
+        dcc.Store(id="route-json"), # serialised route: stops, indexes, song coordinates and the songs to queue
+        dcc.Store(id="error-urls", data={"vc_error": reverse("vc-error")}), # for the clientside redirect
         # dcc.Store(id='sp-client', storage_type="memory"), # TODO: Serialize spotify class
         html.Div([
             html.H2("Vibe Map", style={"text-align": "center"}),
@@ -94,6 +99,7 @@ layout = go.Layout(
         ),
         paper_bgcolor='rgba(0,0,0,0)',
         margin=dict(t=30, r=15, l=15, b=15),
+        uirevision="vibe-map", # keep the camera where it is as songs stream in
         showlegend=False,)
 
 app.layout = serve_layout
@@ -110,11 +116,18 @@ def page_load(n_clicks, session_state=None, **kwargs):
     if session_state is None:
         raise NotImplementedError("Cannot handle a missing session state")
     refresh_token = session_state.get(session_entry, None)
+
+    # On page load use the cached playlist directory if there is one, which skips authenticating too
+    if n_clicks == 0:
+        user_playlists = spotifyAPI.cached_playlists(spotifyAPI.user_key(refresh_token))
+        if user_playlists is not None:
+            return [ {"label":item["name"], "value": item["id"] } for item in user_playlists ]
+
     sp = spotifyAPI.Client(client_creds, refresh_token, refresh=True)
 
-    # Get list of user's playlists
+    # Get list of user's playlists, the Refresh button always fetches a fresh list
     try:
-        user_playlists = sp.get_users_playlists()
+        user_playlists = sp.get_users_playlists(max_age=0 if n_clicks else spotifyAPI.DIRECTORY_TTL)
     except spotifyAPI.AccessRevoked:
         if session_entry in session_state:
             del session_state[session_entry]
@@ -125,103 +138,219 @@ def page_load(n_clicks, session_state=None, **kwargs):
     playlist_dropdown = [ {"label":item["name"], "value": item["id"] } for item in user_playlists ]
     return playlist_dropdown
 
-# When playlist item is selected, save track data as json
+
+# Everything that changes when a playlist is picked, streams in or is routed, updated by update_playlist in one request
+# (a chain of single output callbacks cost a round trip each, and most of them re-sent the whole playlist)
+PLAYLIST_OUTPUTS = [
+    "graph.figure",
+    "graph.extendData",
+    "origin-song.value",
+    "destination-song.value",
+    "load-job.data",
+    "load-progress.children",
+    "load-poll.disabled",
+    "route-json.data",
+    "playlist-display.children",
+]
+EXPIRED_MESSAGE = "This playlist has been unloaded, please select it again."
+
+def playlist_outputs(changed):
+    """ Expects a dictionary of "id.prop": value for the outputs that change
+    Returns update_playlist's outputs in order, leaving the rest as they are """
+    return [ changed.get(name, dash.no_update) for name in PLAYLIST_OUTPUTS ]
+
+# When a playlist is picked, while it loads, and when a route is plotted
 @app.expanded_callback(
-    dash.dependencies.Output("dataframe-json", "data"),
-    [dash.dependencies.Input("playlist-selector", "value")]
+    [dash.dependencies.Output("graph", "figure"),
+    dash.dependencies.Output("graph", "extendData"), # songs loaded since the last poll, added to the plotted ones
+    dash.dependencies.Output("origin-song", "value"),
+    dash.dependencies.Output("destination-song", "value"),
+    dash.dependencies.Output("load-job", "data"),
+    dash.dependencies.Output("load-progress", "children"),
+    dash.dependencies.Output("load-poll", "disabled"),
+    dash.dependencies.Output("route-json", "data"),
+    dash.dependencies.Output("playlist-display", "children")],
+    [dash.dependencies.Input("playlist-selector", "value"), # Input: new playlist
+    dash.dependencies.Input("load-poll", "n_intervals"), # Input: poll timer while it loads
+    dash.dependencies.Input("plot-route", "n_clicks")], # Input: Plot Route button
+    [dash.dependencies.State("load-job", "data"),
+    dash.dependencies.State("origin-song", "value"),
+    dash.dependencies.State("destination-song", "value"),
+    dash.dependencies.State("steps", "value"),
+    dash.dependencies.State("route-json", "data")]
 )
-def load_playlist_data(playlist_uri, session_state=None, **kwargs):
-    if playlist_uri == None:
-        return None
+def update_playlist(playlist_uri, n_intervals, n_clicks, job, origin_uri, destination_uri, steps, route_str, session_state=None, **kwargs):
     if session_state is None:
         raise NotImplementedError("Cannot handle a missing session state")
+
+    # Find out which input triggered the change
+    ctx = dash.callback_context
+    trigger = ctx.triggered[0]["prop_id"] if ctx.triggered else "."
+    if trigger == "plot-route.n_clicks":
+        return playlist_outputs(plot_stops(n_clicks, job, origin_uri, destination_uri, steps))
+    if trigger == "load-poll.n_intervals":
+        return playlist_outputs(stream_playlist(job, route_str, session_state))
+    return playlist_outputs(start_playlist(playlist_uri, job, session_state))
+
+def start_playlist(playlist_uri, job, session_state):
+    """ Clears the previous playlist and its route, and starts loading the new one in the background """
+    if playlist_uri == None and job == None: # page load, nothing to clear
+        raise PreventUpdate
+    changed = {
+        "graph.figure": empty_figure(),
+        "origin-song.value": None, "destination-song.value": None,
+        "route-json.data": None,
+        "playlist-display.children": html.Ul(id="generated-route", children=None),
+    }
+    if playlist_uri == None:
+        changed.update({"load-job.data": None, "load-progress.children": "", "load-poll.disabled": True})
+        return changed
+
+    # Pages and their audio features are fetched concurrently, stream_playlist plots them as they arrive
     refresh_token = session_state.get(session_entry, None)
-    sp = spotifyAPI.Client(client_creds, refresh_token, refresh=True)
-    
-    # Get a JSON for playlist's tracks
-    rjson = sp.get_playlist(playlist_uri)
-
-    # Create Dictionary for track details
-    data = {"artist":[], "track_title":[], "album_art_url":[], "spotify_id":[]}
-    for item in rjson["items"]:
-        data["artist"].append(item["track"]["artists"][0]["name"])
-        data["track_title"].append(item["track"]["name"])
-        data["album_art_url"].append(item["track"]["album"]["images"][2]["url"]) # 0 for 640, 1 for 300, 2 for 64
-        data["spotify_id"].append(item["track"]["id"])
-
-    # Also get Track parameters
-    data["danceability"] = []
-    data["energy"] = []
-    data["valence"] = []
-
-    rjson2 = sp.get_parameters(data["spotify_id"])
-
-    for item in rjson2["audio_features"]:
-        data["energy"].append(item["energy"])
-        data["valence"].append(item["valence"])
-        data["danceability"].append(item["danceability"])
-
-    return json.dumps(data)
-
-# Convert full df json to dict; song artist/title and uri
-@app.callback(
-    dash.dependencies.Output("playlist-songs", "data"),
-    [dash.dependencies.Input("dataframe-json", "data")]
-)
-def update_song_list(main_df_str, **kwargs):
-
-    if main_df_str == None:
-        # raise PreventUpdate
-        return None
-
-     # Create dataframe from dictionary
-    json_data = json.loads(main_df_str)
-    if len(json_data) == 0: # no data
-        print("Ruentint none")
-        return None
-
-    # playlist_dropdown = [ {"label":item["name"], "value": item["id"] } for item in user_playlists ]
-    song_dropdown = []
-    for i in range(len(json_data["artist"])):
-        song_dropdown.append(
-            {"label": f"{json_data['artist'][i]} - {json_data['track_title'][i]}",
-            "value": json_data['spotify_id'][i] }
-        )
-    return song_dropdown
+    job_id = vc_loader.start_load(client_creds, refresh_token, playlist_uri)
+    changed.update({"load-job.data": {"id": job_id, "pages": 0}, "load-progress.children": "Loading songs...",
+                    "load-poll.disabled": False})
+    return changed
+
+def stream_playlist(job, route_str, session_state):
+    """ Adds the pages loaded since the last poll to the graph, and stops polling once the load has finished """
+    if job == None:
+        return {"load-poll.disabled": True}
+
+    progress = vc_loader.load_progress(job["id"])
+    if progress is None: # job expired from the cache
+        return {"load-progress.children": EXPIRED_MESSAGE, "load-poll.disabled": True}
+
+    if progress["status"] == "revoked" and session_entry in session_state:
+        del session_state[session_entry]
+
+    finished = progress["status"] != "loading"
+    if progress["status"] == "loading":
+        message = f"Loading songs... {progress['loaded']}/{progress['total'] or '?'}"
+    elif progress["status"] == "done":
+        message = ""
+    else:
+        message = "Could not load the whole playlist."
+    changed = {"load-progress.children": message, "load-poll.disabled": finished}
+
+    # A big playlist is drawn as its clusters while it loads, a few hundred markers however many songs there are.
+    # Redraw them as they move, and once more when the load finishes and they are final
+    if progress["overview"] is not None:
+        if progress["pages"] == job["pages"] and not finished:
+            return changed
+        route = json.loads(route_str) if route_str else None
+        changed.update({"graph.figure": build_figure(None, route, overview=progress["overview"]),
+                        "load-job.data": {"id": job["id"], "pages": progress["pages"]}})
+        return changed
+
+    # Otherwise only send the new songs, the browser appends them to the points already plotted
+    if progress["pages"] == job["pages"]:
+        return changed
+    rows = vc_loader.load_rows(job["id"], job["pages"], progress["pages"])
+    if rows is None:
+        return {"load-progress.children": EXPIRED_MESSAGE, "load-poll.disabled": True}
+    changed.update({"graph.extendData": [song_points(rows), [0]], "load-job.data": {"id": job["id"], "pages": progress["pages"]}})
+    return changed
+
+def plot_stops(n_clicks, job, origin_uri, destination_uri, steps):
+    """ Routes between the chosen songs, and returns the route, its song list and the updated graph """
+    # Do not update on page load
+    if n_clicks == 0 or job == None or origin_uri == None or destination_uri == None:
+        raise PreventUpdate
+
+    progress = vc_loader.load_progress(job["id"])
+    data = vc_loader.load_rows(job["id"], 0, progress["pages"]) if progress is not None else None
+    if data is None:
+        return {"load-progress.children": EXPIRED_MESSAGE}
+
+    # Get direct path as np array coordinates stops, and playlist route as list of indexes into the playlist data
+    try:
+        # Once a playlist has loaded, route workers map its shared catalog rather than being sent the features
+        catalog = vc_shared.attach(progress.get("catalog"))
+        try:
+            if catalog is None:
+                raise KeyError(progress.get("catalog"))
+            stops, route = vc_workers.route_catalog(catalog, origin_uri, destination_uri, steps)
+        except KeyError: # still loading, or the catalog has been evicted
+            if len(data["spotify_id"]) == 0: # no data
+                raise PreventUpdate
+            stops, route = vc_workers.route(data, origin_uri, destination_uri, steps)
+        # we want to serialise so cannot remain as numpy array, and the route's coordinates let polls redraw it without the playlist
+        route_json = {"stops": stops.tolist(), "route": route,
+                    "points": [ [data["danceability"][idx], data["energy"][idx], data["valence"][idx]] for idx in route ]}
+        figure = vc_workers.figure(build_figure, data, route_json, overview=progress["overview"])
+    except (vc_workers.PoolBusy, vc_workers.PoolTimeout):
+        raise PreventUpdate # too many routes in progress, keep the current route
+
+    # Keep what queue_songs needs with the route, so it doesn't need the playlist
+    route_json["tracks"] = [ {"id": data["spotify_id"][idx], "artist": data["artist"][idx], "title": data["track_title"][idx]}
+                            for idx in route ]
+    # The figure has every page loaded so far, so later polls only add the ones after it
+    return {"graph.figure": figure, "route-json.data": json.dumps(route_json),
+            "playlist-display.children": route_display(data, route),
+            "load-job.data": {"id": job["id"], "pages": progress["pages"]}}
+
+def song_points(rows):
+    """ Expects a playlist data dictionary and returns its songs as extendData for plot_master_df's trace """
+    return {
+        "x": [rows["danceability"]], "y": [rows["energy"]], "z": [rows["valence"]],
+        "text": [ [ f"{artist} - {title}" for artist, title in zip(rows["artist"], rows["track_title"]) ] ],
+        "marker.color": [rows["energy"]],
+    }
+
+# Song dropdowns only hold the songs matching what has been typed, so a big playlist is never sent to them whole
+SEARCH_LIMIT = 50 # songs offered at once
 
-# Update 2 song drop downs with playlist songs
-@app.callback(
+@app.expanded_callback(
     dash.dependencies.Output("origin-song", "options"),
-    [dash.dependencies.Input("playlist-songs", "data")]
+    [dash.dependencies.Input("origin-song", "search_value"),
+    dash.dependencies.Input("playlist-selector", "value")], # Input: new playlist, clear the songs
+    [dash.dependencies.State("origin-song", "value"),
+    dash.dependencies.State("load-job", "data")]
 )
-def update_songs_dropdowns(songs, **kwargs):
-    if type(songs) == type(None):
-        return ""
-    return songs
+def search_origin(search_value, playlist_uri, value, job, **kwargs):
+    return search_songs(search_value, value, job)
 
-@app.callback(
+@app.expanded_callback(
     dash.dependencies.Output("destination-song", "options"),
-    [dash.dependencies.Input("playlist-songs", "data")]
+    [dash.dependencies.Input("destination-song", "search_value"),
+    dash.dependencies.Input("playlist-selector", "value")],
+    [dash.dependencies.State("destination-song", "value"),
+    dash.dependencies.State("load-job", "data")]
 )
-def update_songs_dropdowns(songs, **kwargs):
-    if type(songs) == type(None):
-        return ""
-    return songs
+def search_destination(search_value, playlist_uri, value, job, **kwargs):
+    return search_songs(search_value, value, job)
 
-# When song dropdowns are updated, clear their value
-@app.callback(
-    dash.dependencies.Output("origin-song", "value"),
-    [dash.dependencies.Input("origin-song", "options")]
-)
-def update_songs_dropdowns(songs, **kwargs):
-    return None
+def search_songs(search_value, value, job):
+    """ Returns up to SEARCH_LIMIT song options whose artist - title contains search_value, and the chosen song
+    so the dropdown can still show it """
+    ctx = dash.callback_context
+    trigger = ctx.triggered[0]["prop_id"] if ctx.triggered else "."
+    if trigger == "playlist-selector.value":
+        return []
+    if job == None or not search_value: # keep the options while the search is cleared
+        raise PreventUpdate
 
-@app.callback(
-    dash.dependencies.Output("destination-song", "value"),
-    [dash.dependencies.Input("destination-song", "options")]
-)
-def update_songs_dropdowns(songs, **kwargs):
-    return None
+    # Only the labels are searched, the pages of song data are left in the cache
+    index = vc_loader.load_labels(job["id"]) if vc_loader.load_progress(job["id"]) is not None else None
+    if index is None:
+        return []
+    search_value = search_value.lower()
+    matches = [ {"label": label, "value": spotify_id} for label, spotify_id in zip(index["labels"], index["ids"])
+                if search_value in label.lower() ][:SEARCH_LIMIT]
+    if value is not None and value not in [ option["value"] for option in matches ] and value in index["ids"]:
+        matches.append({"label": index["labels"][index["ids"].index(value)], "value": value})
+    return matches
+
+def route_display(data, route):
+    """ Expects the playlist data dictionary and route indexes, and returns the route's song list """
+    route_songs = []
+    for idx in route:
+        my_str = f"{data['artist'][idx]} - {data['track_title'][idx]}"
+        img = html.Img(src=data["album_art_url"][idx], height="32")
+        route_songs.append(html.Li([img, my_str]))
+    return html.Ul(id="generated-route", children=route_songs)
 
 # Plot the main dataframe to the graph
 def plot_master_df(df):
@@ -247,6 +376,29 @@ def plot_master_df(df):
 
     return plot_data_tracks
 
+def plot_clusters(overview):
+    """ Expects a playlist's cluster overview (centroids, counts and regions, see vc_clusters.summary) and returns one
+    marker per cluster, sized by its number of songs
+    Used instead of plot_master_df for very large playlists, so the figure's size depends on clusters not songs """
+    centroids, counts, regions = overview
+    return go.Scatter3d(
+        x=centroids[:, 0], y=centroids[:, 1], z=centroids[:, 2],
+        text=[ f"{count} songs" for count in counts ],
+        hovertemplate =
+            '<b>%{text}</b><br>' +
+            'danceability: %{x:.2f}<br>'+
+            'energy: %{y:.2f}<br>' +
+            'valence: %{z:.2f}' +
+            '<extra></extra>',
+        mode="markers",
+        marker=dict(
+            size=np.clip(np.sqrt(counts), 4, 30),
+            color=regions,
+            colorscale='Viridis',
+            opacity=0.6
+        )
+    )
+
 def plot_route(route_df):
     """ expects df[playlist] and returns plotly objects  """
     return go.Scatter3d(x=route_df["danceability"], y=route_df["energy"], z=route_df["valence"],
@@ -275,221 +427,142 @@ def plot_direct(stops):
                        )
                     )
 
-# Update main Graph
-@app.callback(
-    dash.dependencies.Output("graph", "figure"),
-    [dash.dependencies.Input("dataframe-json", "data"), # Input: Dataframe, or Plot Route button > route json
-    dash.dependencies.Input("route-json", "data")]
-)
-def plot_playlist_data(main_df_str, route_str, **kwargs):
-
-    # Find out which input triggered the change
-    ctx = dash.callback_context
-    if ctx.triggered[0]["prop_id"] == "dataframe-json.data": # if we have picked a new playlist
-        route_str = None # clear the route
+def empty_figure():
+    """ Returns the Vibe Map with an empty song trace, which stream_playlist adds songs to as they load """
+    return { "data":[plot_master_df(pd.DataFrame(vc_loader.empty_data(), dtype=object))], "layout":layout }
 
-    # Create dataframe from dictionary]
-    if main_df_str == None:
-        raise PreventUpdate
-    main_df_json = json.loads(main_df_str)
-    if len(main_df_json) == 0: # no data
-        raise PreventUpdate
-    df = pd.DataFrame(main_df_json)
+def build_figure(data, route_json=None, overview=None):
+    """ Expects the playlist data dictionary, the route dictionary if there is one, and the playlist's cluster overview
+    from vc_loader if it has too many songs to draw (then data isn't needed)
+    Returns the Vibe Map figure """
 
-    # Get plotly object for main df
-    plot_data_tracks = plot_master_df(df)
+    # Get plotly object for main df, or a summary of its clusters if there are too many songs to draw
+    if overview is not None:
+        plot_data_tracks = plot_clusters(overview)
+    elif len(data["spotify_id"]) == 0: # no data
+        return { "data":[], "layout":layout }
+    else:
+        # Create dataframe from dictionary
+        df = pd.DataFrame(data)
+        plot_data_tracks = plot_master_df(df)
 
     # Load any routes may have been passed in
-    if type(route_str) == type(None):
+    if route_json is None:
         return { "data":[plot_data_tracks], "layout":layout }
     else:
-        route_json = json.loads(route_str)
-        stops = route_json["stops"]
-        playlist = route_json["route"]
-
         # Plot other lines
-        plot_direct_route = plot_direct(stops)
-        plot_playlist_route = plot_route(df.iloc[playlist])
+        plot_direct_route = plot_direct(route_json["stops"])
+        plot_playlist_route = plot_route(pd.DataFrame(route_json["points"], columns=["danceability", "energy", "valence"]))
         return { "data":[plot_data_tracks, plot_direct_route, plot_playlist_route], "layout":layout }
 
-
-# Get Route to plot
-@app.callback(
-    dash.dependencies.Output("route-json", "data"),
-    [dash.dependencies.Input("plot-route", "n_clicks"), # Input: Plot Route Button
-    dash.dependencies.Input('playlist-selector', 'value')], # Input: change of playlist
-    [dash.dependencies.State("origin-song", "value"),
-    dash.dependencies.State("destination-song", "value"),
-    dash.dependencies.State("steps", "value"),
-    dash.dependencies.State("dataframe-json", "data")]
-)
-def get_stops(n_clicks, refresh, origin_uri, destination_uri, steps, json_data, **kwargs):
-    
-    # Do not update on page load
-    if n_clicks == 0 or origin_uri == None or destination_uri == None:
-        raise PreventUpdate
-
-    # Find out which input triggered the change
-    ctx = dash.callback_context
-    if ctx.triggered[0]["prop_id"] == "playlist-selector.value": # if we have picked a new playlist
-        return None # Clear json
-
-    # Create dataframe from dictionary
-    data = json.loads(json_data)
-    if len(data) == 0: # no data
-        raise PreventUpdate
-    df = pd.DataFrame(data)
-    
-    # Get direct path as np array coordinates stops, and playlist route as list of indexes for main df
-    stops, route = vc_linalg.plot_bearing(df, origin_uri, destination_uri, steps)
-    stops = stops.tolist() # we want to serialise so cannot remain as numpy array
-
-    route_data = {"stops": stops, "route": route}
-    return json.dumps(route_data)
-
-# Once route is generated, display in div
-@app.callback(
-    dash.dependencies.Output("playlist-display", "children"),
-    [dash.dependencies.Input("route-json", "data")], # Input: Route Data update
-    [dash.dependencies.State("dataframe-json", "data")], 
-)
-def display_route(route_str, main_df_str, **kwargs):
-
-    if type(route_str) == type(None):
-        return html.Ul(id="generated-route", children=None)
-
-    # Create dataframe from dictionary
-    main_df_json = json.loads(main_df_str)
-    if len(main_df_json) == 0: # no data
-        raise PreventUpdate
-    df = pd.DataFrame(main_df_json)
-
-    route_json = json.loads(route_str)
-    playlist = route_json["route"]
-    route_df = df.iloc[playlist]
-
-    route_songs = []
-    for row in route_df.iterrows():
-        my_str = f"{row[1]['artist']} - {row[1]['track_title']}"
-        img = html.Img(src=row[1]['album_art_url'], height="32")
-        # ele = html.Span([img, html.Li(my_str)])
-        ele = html.Li([img, my_str])
-        route_songs.append(ele)
-
-    return html.Ul(id="generated-route", children=route_songs)
-
-# Enable/Disable queue button
-@app.callback(
-    dash.dependencies.Output("queue-playlist", "disabled"),
-    [dash.dependencies.Input("queued-modal", "children"), # Input: queue playlists button
-    dash.dependencies.Input("route-json", "data")], # Input: Route Data update 
-)
-def toggle_queue_button(queued_modal, route_str, **kwargs):
-    ctx = dash.callback_context
-    
-    # Big nested if to check if modal is result of an error (no spotify device)
-    if type(queued_modal) != type(None):
-        if "props" in queued_modal:
-            if "className" in queued_modal["props"]:
-                if queued_modal["props"]["className"] == "modal-error":
-                    raise PreventUpdate
-
-    if ctx.triggered[0]["prop_id"] == "route-json.data": # if we have generated a new route
-        if route_str == None:
-            return True
-        else:
-            return False
-    elif ctx.triggered[0]["prop_id"] == "queued-modal.children": # if we queue songs
-        return True # disable the button to prevent it being double clicked
-
-# Change queue button text
-@app.callback(
+# Enable/Disable the queue and save buttons and change their text, in the browser as they only depend on the route and the modal
+app.clientside_callback(
+    """
+    function(queued_modal, route_str) {
+        var triggered = dash_clientside.callback_context.triggered.map(function(t) { return t.prop_id; });
+        var no_update = dash_clientside.no_update;
+        if (triggered.indexOf("queued-modal.children") !== -1) { // if we queue or save songs
+            // Leave the buttons alone if the modal is the result of an error (no spotify device)
+            if (queued_modal && queued_modal.props && queued_modal.props.className === "modal-error") {
+                return [no_update, no_update, no_update, no_update];
+            }
+            // disable the button to prevent it being double clicked
+            if (queued_modal && queued_modal.props && String(queued_modal.props.id).indexOf("saved-") === 0) {
+                return [no_update, no_update, true, "Saved ✔️"];
+            }
+            return [true, "Queued ✔️", no_update, no_update];
+        }
+        return [!route_str, "Add to Queue", !route_str, "Save as Playlist"]; // if we have generated a new route
+    }
+    """,
+    [dash.dependencies.Output("queue-playlist", "disabled"),
     dash.dependencies.Output("queue-playlist", "children"),
-    #[dash.dependencies.Input("queue-playlist", "n_clicks"), # Input: queue playlists button
+    dash.dependencies.Output("save-playlist", "disabled"),
+    dash.dependencies.Output("save-playlist", "children")],
     # Because we need the modal to update to check for errors, we use modal as input and not button
-    [dash.dependencies.Input("queued-modal", 'children'),
-    dash.dependencies.Input("route-json", "data")], # Input: Route Data update 
-    #[dash.dependencies.State("queued-modal", 'children')]
+    [dash.dependencies.Input("queued-modal", "children"),
+    dash.dependencies.Input("route-json", "data")], # Input: Route Data update
 )
-def change_queue_text(queued_modal, route_str, **kwargs):
-    ctx = dash.callback_context
-
-    # Big nested if to check if modal is result of an error (no spotify device)
-    if type(queued_modal) != type(None):
-        if "props" in queued_modal:
-            if "className" in queued_modal["props"]:
-                if queued_modal["props"]["className"] == "modal-error":
-                    raise PreventUpdate
-
-    if ctx.triggered[0]["prop_id"] == "route-json.data": # if we have generated a new route
-        return "Add to Queue"
-    elif ctx.triggered[0]["prop_id"] == "queued-modal.children": # if we queue songs
-        return "Queued ✔️"
 
-# Queue songs
+# Queue songs, or save them as a playlist
 @app.expanded_callback(
     dash.dependencies.Output("queued-modal", 'children'),
-    [dash.dependencies.Input("queue-playlist", "n_clicks")], # Input: Queue Songs Button 
-    [dash.dependencies.State("dataframe-json", "data"),
-    dash.dependencies.State("route-json", "data")]
+    [dash.dependencies.Input("queue-playlist", "n_clicks"), # Input: Queue Songs Button
+    dash.dependencies.Input("save-playlist", "n_clicks")], # Input: Save as Playlist Button
+    [dash.dependencies.State("route-json", "data")]
 )
-def queue_songs(n_clicks, main_df_str, route_str, session_state=None, **kwargs):
+def send_route(queue_clicks, save_clicks, route_str, session_state=None, **kwargs):
 
     if session_state is None:
         raise NotImplementedError("Cannot handle a missing session state")
     refresh_token = session_state.get(session_entry, None)
-    sp = spotifyAPI.Client(client_creds, refresh_token, refresh=True)
 
     if type(route_str) == type(None): # empty json
         raise PreventUpdate
 
-    if n_clicks == 0:
+    # Find out which button was pressed
+    ctx = dash.callback_context
+    trigger = ctx.triggered[0]["prop_id"] if ctx.triggered else "."
+    if trigger == "save-playlist.n_clicks" and save_clicks:
+        send = save_songs
+    elif trigger == "queue-playlist.n_clicks" and queue_clicks:
+        send = queue_songs
+    else:
         raise PreventUpdate
 
-    # Queue songs
     route_json = json.loads(route_str)
-
-    # Create dataframe from dictionary
-    main_df_json = json.loads(main_df_str)
-    df = pd.DataFrame(main_df_json)
-
-    playlist = route_json["route"]
-    route_df = df.iloc[playlist]
-    
-    songs_queued = [html.B(html.Li("Queued songs:"))]
+    sp = spotifyAPI.Client(client_creds, refresh_token, refresh=True)
 
     # We generate a random number as the id, as the js frontend is looking for a change in DOM
     # It unfortunately does not see changes in the li elements, only in the immediate child (Ul)
     from random import choice
     num = str(choice(range(1,1000000)))
-    id = f"random-{num}"
-    
-    for row in route_df.iterrows():
-        artist = row[1]["artist"]
-        track_title = row[1]["track_title"]
-        track_id = row[1]["spotify_id"]
-        try:
-            sp.queue_song(track_id)
-        except spotifyAPI.AccessRevoked:
+
+    try:
+        return send(sp, route_json["tracks"], num)
+    except spotifyAPI.AccessRevoked:
+        if session_entry in session_state:
+            del session_state[session_entry]
+        return dcc.Location(pathname=reverse("vc-error-generic"), id="foo")
+    except spotifyAPI.NoDevice:
+        return html.Div("Could not find an active device! Please launch Spotify and try starting a song.", className="modal-error", id=f"random-{num}")
+    except spotifyAPI.InvalidRequest as e:
+        if send is save_songs and e.status_code == 403: # logged in before Vibe Compass asked to modify playlists
             if session_entry in session_state:
-                del session_state[session_entry]
-            return dcc.Location(pathname=reverse("vc-error-generic"), id="foo")
-        except spotifyAPI.NoDevice:
-            return html.Div("Could not find an active device! Please launch Spotify and try starting a song.", className="modal-error", id=id)
-        except spotifyAPI.InvalidRequest:
-            return dcc.Location(pathname=reverse("vc-error-generic"), id="foo")
-        
-        songs_queued.append(html.Li(f"{artist} - {track_title}"))
-   
-    return html.Ul(songs_queued, id=id)
+                del session_state[session_entry] # so the next page load asks Spotify again
+            return html.Div("Vibe Compass needs permission to save playlists. Please reload the page to grant it.", className="modal-error", id=f"saved-{num}")
+        return dcc.Location(pathname=reverse("vc-error-generic"), id="foo")
+
+def queue_songs(sp, tracks, num):
+    """ Adds the route's songs to the user's queue, one request per song, and returns the modal listing them """
+    songs_queued = [html.B(html.Li("Queued songs:"))]
+    for track in tracks:
+        sp.queue_song(track["id"])
+        songs_queued.append(html.Li(f"{track['artist']} - {track['title']}"))
+    return html.Ul(songs_queued, id=f"random-{num}")
+
+def save_songs(sp, tracks, num):
+    """ Saves the route as a new private playlist, which needs no active device, and returns the modal linking to it """
+    first, last = tracks[0], tracks[-1]
+    name = f"Vibe Compass: {first['artist']} - {first['title']} to {last['artist']} - {last['title']}"
+    playlist = sp.save_playlist(name[:100], [ track["id"] for track in tracks ], description="A route plotted with Vibe Compass")
+    songs_saved = [html.B(html.Li(["Saved to ", html.A(playlist["name"], href=playlist["external_urls"]["spotify"], target="_blank")]))]
+    for track in tracks:
+        songs_saved.append(html.Li(f"{track['artist']} - {track['title']}"))
+    return html.Ul(songs_saved, id=f"saved-{num}")
 
 # Error handling
-# Redirects to error page on Spotify API failure
-@app.callback(
+# Redirects to error page on Spotify API failure, in the browser as the error url is in the layout
+app.clientside_callback(
+    """
+    function(options, error_urls) {
+        if (options && options.length > 0 && options[0].label === "error" && options[0].value === "vc_error") {
+            window.location.assign(error_urls.vc_error);
+        }
+        return dash_clientside.no_update;
+    }
+    """,
     dash.dependencies.Output("redirect-div", 'children'),
     [dash.dependencies.Input("playlist-selector", 'options')],
+    [dash.dependencies.State("error-urls", "data")],
 )
-def redirecter(options, **kwargs):
-    if len(options) > 0:
-        if options[0]["label"] == "error" and options[0]["value"] == "vc_error":
-            return dcc.Location(pathname=reverse("vc-error"), id="foo")